@@ -0,0 +1,378 @@
+import time
+import signal
+import asyncio
+import threading
+import redis
+import redis.asyncio as aioredis
+
+from chat_server import (
+    ChatServer, redis_options, history_key, history_entries, with_unwritten, entries_since, older_than, buffered_messages,
+    text_handshake, parse_handshake, parse_hello, parse_history_request, parse_room_command, encode_history,
+    enable_keepalive, set_tcp_mode, uncork, HISTORY_LIMIT, HISTORY_PAGE_SCAN, MAX_MESSAGE
+)
+from outbound import AsyncOutboundQueue
+from protocol import MAGIC, JOIN_COMMAND, PING_COMMAND, ROOM_PREFIX, FrameDecoder, LineDecoder, ProtocolError, is_room
+from metrics import start_metrics_server
+
+# Seconds drain waits for the handlers of the connections it closed
+CLOSE_GRACE = 2
+
+
+class AsyncChatServer(ChatServer):
+    """ChatServer variant that serves every connection from one asyncio event loop.
+
+    A Connection's stream is the StreamWriter instead of the socket; the handshake, history replay and push
+    semantics are the same as the threaded engine. Cross-replica fan-out runs
+    on the RedisFanout threads and hands remote messages back to the loop.
+    """
+
+    engine = "asyncio"
+    outbound_class = AsyncOutboundQueue
+
+    def __init__(self, port, async_redis_factory=None, **options):
+        # Synchronous clients from redis_factory stay with the helper threads
+        # (fan-out, write-behind); the loop gets its own from async_redis_factory
+        self.async_redis_factory = async_redis_factory or (lambda: aioredis.Redis(**redis_options()))
+        self.loop = None
+        super().__init__(port, **options)
+
+    def handler_redis(self):
+        return self.async_redis_factory()
+
+    def deliver_remote(self, username, recipient, message, ts=None):
+        # Called on the fanout subscriber thread
+        self.loop.call_soon_threadsafe(self.receive_remote, username, recipient, message, ts)
+
+    async def save_message(self, username, recipient, message, ts):
+        key = history_key(username, recipient)
+        entry = self.encode_entry(username, recipient, message, ts)
+        if self.retention is not None:
+            self.retention.touch(key)
+        with self.metrics.save_latency.time(), self.tracer.span("save"):
+            try:
+                if self.message_writer is None:
+                    with self.tracer.span("redis"):
+                        await self.redis.rpush(key, entry)
+                    self.cache_message(username, recipient, message, ts)
+                    return
+
+                ack = self.queue_message(key, username, recipient, message, entry, ts)
+                if self.persistence == "sync":
+                    with self.tracer.span("ack"):
+                        # Shielded: the ack is shared by the whole batch, and
+                        # a cancelled sender must not cancel it for the rest
+                        await asyncio.shield(asyncio.wrap_future(ack))
+            except redis.RedisError:
+                self.metrics.redis_errors.inc(operation="save_message")
+                raise
+
+    async def load_history(self, key):
+        token = None
+        if self.history_cache is not None:
+            entries = self.history_cache.get(key)
+            if entries is not None:
+                return entries
+            token = self.history_cache.start_load(key)
+        # Taken before the read: an entry flushed in between is then in
+        # both, and one queued after it marks the load stale
+        unwritten = self.message_writer.unwritten(key) if self.message_writer is not None else []
+
+        try:
+            with self.tracer.span("redis"):
+                raw = await self.redis.lrange(key, -HISTORY_LIMIT, -1)
+        except redis.RedisError:
+            self.metrics.redis_errors.inc(operation="load_history")
+            raise
+        if unwritten:
+            raw = with_unwritten(raw, unwritten)
+        with self.tracer.span("decode"):
+            entries = history_entries(raw)
+        if token is not None:
+            self.history_cache.fill(key, entries, token)
+        return entries
+
+    async def load_page(self, key, before, limit):
+        page = []
+        end = -1
+        while len(page) < limit:
+            chunk = await self.redis.lrange(key, end - HISTORY_PAGE_SCAN + 1, end)
+            page = older_than(history_entries(chunk), before) + page
+            if len(chunk) < HISTORY_PAGE_SCAN:
+                break
+            end -= HISTORY_PAGE_SCAN
+        return page[-limit:]
+
+    async def send_history(self, writer, username, recipient, framing=None, since=None):
+        with self.metrics.history_latency.time(), self.tracer.span("history"):
+            entries = entries_since(await self.load_history(history_key(username, recipient)), since)
+
+            with self.tracer.span("send"):
+                writer.write(encode_history(framing, entries, stamped=since is not None))
+                await writer.drain()
+
+    async def send_page(self, username, conn_data, before, limit):
+        entries = await self.load_page(history_key(username, conn_data.target), before, limit)
+        self.enqueue(username, conn_data, encode_history(conn_data.framing, entries, stamped=True))
+
+    async def send_room_history(self, username, conn_data, room):
+        entries = await self.load_history(history_key(username, room))
+        self.enqueue(username, conn_data, encode_history(conn_data.framing, entries, stamped=conn_data.stamped))
+
+    async def handle_message(self, username, conn_data, recipient, message):
+        if message.strip() == PING_COMMAND:
+            return
+
+        delay = self.connection_delay(conn_data)
+        if delay:
+            with self.tracer.span("rate_limit"):
+                await asyncio.sleep(delay)
+
+        request = parse_history_request(message) if conn_data.stamped else None
+        if request is not None:
+            await self.send_page(username, conn_data, *request)
+            return
+
+        command = parse_room_command(message)
+        if command is not None:
+            command, room = command
+            if room is None:
+                self.notify(username, conn_data, f"Usage: {command} {ROOM_PREFIX}<room>")
+            elif command == JOIN_COMMAND:
+                self.join_room(username, conn_data, room)
+                await self.send_room_history(username, conn_data, room)
+                await self.push("server", room, f"[{username}] joined {room}")
+            else:
+                self.leave_room(username, conn_data, room)
+                await self.push("server", room, f"[{username}] left {room}")
+            return
+
+        recipient = recipient or conn_data.target
+        if is_room(recipient) and recipient not in conn_data.rooms:
+            self.notify(username, conn_data, f"Join {recipient} before sending to it")
+            return
+        delay = self.room_delay(recipient)
+        if delay:
+            with self.tracer.span("rate_limit"):
+                await asyncio.sleep(delay)
+        await self.push(username, recipient, message)
+
+    def abort(self, conn_data):
+        # Always called on the event loop
+        conn_data.stream.transport.abort()
+
+    async def reaper_task(self):
+        while True:
+            await asyncio.sleep(self.idle_timeout / 4)
+            self.reap_idle()
+
+    async def writer_task(self, username, conn_data):
+        writer, outbound = conn_data.stream, conn_data.outbound
+        sock = writer.get_extra_info("socket")
+        while True:
+            data = await outbound.get()
+            if data is None:
+                return
+            try:
+                writer.write(data)
+                await writer.drain()
+                if self.corked:
+                    uncork(sock)
+            except (OSError, BrokenPipeError, ConnectionResetError):
+                self.drop_connection(username, conn_data)
+                return
+            self.metrics.send_batch_frames.observe(outbound.batch)
+            self.metrics.send_batch_bytes.observe(len(data))
+
+    async def push(self, username, recipient, message):
+
+        if "HISTORY_END" in message:
+            return
+
+        message = message.rstrip("\n")
+
+        ts = None
+        if username != "server":
+            self.metrics.messages_in.inc()
+            ts = self.clock.now()
+            await self.save_message(username, recipient, message, ts)
+
+        with self.tracer.span("deliver"):
+            delivered = self.deliver_local(username, recipient, message, ts)
+
+        # Other replicas only need a DM when the recipient is not connected here
+        if self.fanout is not None and (recipient == "BROADCAST" or is_room(recipient) or not delivered):
+            self.fanout.publish(username, recipient, message, ts)
+
+    async def receive(self, reader, framing, lines=None):
+        try:
+            data = await reader.read(65536)
+        except OSError:
+            return None
+        if not data:
+            return None
+        (lines if framing is None else framing).feed(data)
+        return buffered_messages(framing, lines)
+
+    async def read_handshake(self, reader):
+        data = await reader.read(1024)
+        while data and len(data) < len(MAGIC) and MAGIC.startswith(data):
+            data += await reader.read(1024)
+        if not data.startswith(MAGIC):
+            lines = LineDecoder(max_line=MAX_MESSAGE)
+            lines.feed(data)
+            handshake = text_handshake(lines)
+            while handshake is None:
+                data = await reader.read(1024)
+                if not data:
+                    raise ConnectionError("Connection closed during handshake")
+                lines.feed(data)
+                handshake = text_handshake(lines)
+            username, recipient, since = parse_handshake(handshake)
+            return username, recipient, None, since, lines
+
+        framing = FrameDecoder(max_frame=MAX_MESSAGE)
+        framing.feed(data[len(MAGIC):])
+        while True:
+            hello = parse_hello(framing)
+            if hello is not None:
+                return hello[0], hello[1], framing, hello[2], None
+            data = await reader.read(65536)
+            if not data:
+                raise ConnectionError("Connection closed during handshake")
+            framing.feed(data)
+
+    async def handle_client(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        if not self.admit(peer[0] if peer else None):
+            writer.close()
+            return
+
+        start = time.perf_counter()
+        try:
+            with self.tracer.span("handshake"):
+                username, recipient, framing, since, lines = await asyncio.wait_for(
+                    self.read_handshake(reader), self.handshake_timeout
+                )
+        except asyncio.TimeoutError:
+            self.metrics.connections.inc(result="timeout")
+            writer.close()
+            return
+        except (OSError, UnicodeDecodeError, ProtocolError):
+            self.metrics.connections.inc(result="invalid")
+            writer.close()
+            return
+        self.metrics.connections.inc(result="ok")
+        self.metrics.handshake_latency.observe(time.perf_counter() - start)
+        sock = writer.get_extra_info("socket")
+        if self.keepalive:
+            enable_keepalive(sock, self.keepalive)
+        set_tcp_mode(sock, self.tcp_mode)
+
+        conn_data = self.add_connection(username, writer, recipient, framing, stamped=since is not None)
+        print(f"[{username}] connected (session {conn_data.session})")
+
+        try:
+            await self.send_history(writer, username, recipient, framing, since)
+            if self.corked:
+                uncork(sock)
+        except Exception:
+            # Redis errors included: the user must not stay registered
+            self.close_session(username, conn_data)
+            writer.close()
+            return
+
+        # Live messages queued during the replay go out after HISTORY_END
+        writer_task = asyncio.create_task(self.writer_task(username, conn_data))
+
+        await self.push("server", recipient, f"[{username}] connected")
+
+        # Messages sent right behind the handshake are already buffered
+        messages = buffered_messages(framing, lines)
+        try:
+            while messages is not None:
+                conn_data.last_active = time.monotonic()
+                for message_recipient, msg in messages:
+                    try:
+                        with self.tracer.span("message"):
+                            await self.handle_message(username, conn_data, message_recipient, msg)
+                    except redis.RedisError as e:
+                        self.message_failed(username, conn_data, e)
+
+                messages = await self.receive(reader, framing, lines)
+            print(f"[{username}] session {conn_data.session} closed")
+        finally:
+            # Also on an unexpected error, so the session is never left registered
+            current = self.close_session(username, conn_data)
+            await writer_task
+            writer.close()
+
+        # A session that was taken over leaves quietly, and so does
+        # everyone while the server drains
+        if current and not self.draining:
+            await self.push("server", recipient, f"[{username}] disconnected")
+
+    async def drain(self):
+        self.draining = True
+        count = self.send_reconnects()
+        print(f"Draining: asked {count} connections to reconnect within {self.drain_timeout / 2:g}s")
+        deadline = time.monotonic() + self.drain_timeout
+        while self.connections and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        self.close_all()
+        # Aborting only schedules the close; give the handlers a moment to
+        # run their cleanup before asyncio.run cancels whatever is left
+        deadline = time.monotonic() + CLOSE_GRACE
+        while self.open_sessions and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+    async def serve(self, sock):
+        self.loop = asyncio.get_running_loop()
+        if self.fanout is not None:
+            self.fanout.start()
+        if self.message_writer is not None:
+            self.message_writer.start()
+        if self.retention is not None:
+            self.retention.start()
+        if self.metrics_port:
+            start_metrics_server(self.metrics, self.metrics_port, self.instrumentation)
+        reaper = None
+        if self.idle_timeout:
+            # Keep a reference, the loop only holds tasks weakly
+            reaper = asyncio.create_task(self.reaper_task())
+
+        server = await asyncio.start_server(self.handle_client, sock=sock, backlog=self.backlog)
+        drain_requested = asyncio.Event()
+        # Signal handlers can only be installed from the main thread; a
+        # server embedded in a thread (the benchmarks) runs until its loop stops
+        signals = threading.current_thread() is threading.main_thread()
+        if signals:
+            self.loop.add_signal_handler(signal.SIGTERM, drain_requested.set)
+            for signum, handler in self.instrumentation.signal_handlers():
+                self.loop.add_signal_handler(signum, handler)
+        try:
+            async with server:
+                await drain_requested.wait()
+                # Stop accepting; the open connections are served until they leave
+                server.close()
+                if signals:
+                    self.loop.add_signal_handler(signal.SIGTERM, self.close_all)
+                await self.drain()
+        finally:
+            if reaper is not None:
+                reaper.cancel()
+                try:
+                    await reaper
+                except asyncio.CancelledError:
+                    pass
+            await self.redis.aclose()
+
+    def execute(self, sock):
+        try:
+            sock.bind(('0.0.0.0', self.port))
+            sock.listen(self.backlog)
+        except OSError:
+            print("Failed to bind to port: " + str(self.port))
+            return
+
+        print("Listening for connections on: " + str(self.port))
+        asyncio.run(self.serve(sock))
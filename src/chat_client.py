@@ -1,7 +1,38 @@
 import sys
+import random
 import socket
+import argparse
 import threading
 
+from protocol import (
+    MAGIC, HELLO, MESSAGE, HISTORY, HISTORY_END, RECONNECT, RECONNECT_LINE, HISTORY_COMMAND, PING_COMMAND,
+    FrameDecoder, LineDecoder, encode_frame, is_room, split_stamp
+)
+
+PAGE_SIZE = 50
+# Well inside any sensible server --idle-timeout
+HEARTBEAT_INTERVAL = 30
+# Reconnect attempt n waits a random time up to BACKOFF_BASE * 2**n seconds,
+# capped at BACKOFF_MAX
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+MAX_RECONNECT_ATTEMPTS = 10
+
+
+def backoff(attempt):
+    # Fully jittered, so clients that lost the same server spread out
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def render_frame(frame_type, sender, recipient, payload):
+    if frame_type == HISTORY:
+        return payload
+    if frame_type == MESSAGE:
+        if recipient == "BROADCAST" or is_room(recipient):
+            return f"\\{recipient}/[{sender}]: {payload}\n"
+        return f"[{sender}]: {payload}\n"
+    return ""
+
 
 class ChatClient:
     def __init__(self, host, port, username):
@@ -9,14 +40,86 @@ class ChatClient:
         self.port = int(port)
         self.username = username
         self.recipient = None
+        self.framed = False
+        self.framing = None
+        self.lines = None
+        # IDs of the newest and oldest stored messages seen so far: the
+        # handshake asks for everything after last_seen, "/older" pages
+        # back from oldest_seen
+        self.last_seen = None
+        self.oldest_seen = None
+        # The writing and heartbeat threads share the socket
+        self.sock = None
+        self.send_lock = threading.Lock()
+        # Set when the current connection is over; moving means the server
+        # asked us to go, so we reconnect without backing off
+        self.lost = threading.Event()
+        self.moving = False
 
-    def reading_thread(self, sock, stop_event):
+    def server_moving(self, delay_ms):
+        # Stay until the server's chosen time so nothing is missed, then move
+        try:
+            delay = int(delay_ms) / 1000
+        except ValueError:
+            delay = 0
+        self.moving = True
+        timer = threading.Timer(delay, self.lost.set)
+        timer.daemon = True
+        timer.start()
+        sys.stdout.write(f"\rServer is shutting down, reconnecting in {delay:.1f}s\n")
 
-        while not stop_event.is_set():
+    def text_line(self, line):
+        if line.startswith(RECONNECT_LINE + " "):
+            self.server_moving(line[len(RECONNECT_LINE) + 1:])
+            return ""
+        return line + "\n"
+
+    def render(self, frame):
+        frame_type, sender, recipient, payload = frame
+        if frame_type == RECONNECT:
+            self.server_moving(payload)
+            return ""
+        if frame_type == MESSAGE:
+            # Live frames carry their stamp in the payload
+            ts, payload = split_stamp(payload)
+            self.seen(ts)
+        return render_frame(frame_type, sender, recipient, payload)
+
+    def seen(self, ts):
+        if ts is not None:
+            self.last_seen = max(self.last_seen or ts, ts)
+            self.oldest_seen = min(self.oldest_seen or ts, ts)
+
+    def unstamp(self, text):
+        lines = []
+        # Only "\n" ends a line: splitlines would also split on "\r", U+2028
+        # and the like inside a message, and take what follows for a stamp
+        for line in text.split("\n"):
+            ts, line = split_stamp(line)
+            self.seen(ts)
+            if line != "HISTORY_END":
+                lines.append(line)
+        return "\n".join(lines)
+
+    def read(self, sock):
+        if self.framing is None:
+            if self.lines.recv_into(sock) == 0:
+                return ""
+            return self.unstamp("".join(self.text_line(line) for line in self.lines.lines())) or None
+
+        if self.framing.recv_into(sock) == 0:
+            return ""
+        return self.unstamp("".join(self.render(frame) for frame in self.framing.frames())) or None
+
+    def reading_thread(self, sock, lost):
+
+        while not lost.is_set():
             try:
-                msg = sock.recv(4096).decode("utf-8")
+                msg = self.read(sock)
+                if msg is None:
+                    continue
                 if not msg:
-                    stop_event.set()
+                    lost.set()
                     break
 
                 sys.stdout.write("\r" + msg)
@@ -24,78 +127,165 @@ class ChatClient:
                 sys.stdout.flush()
 
             except:
-                stop_event.set()
+                lost.set()
                 break
 
-    def writing_thread(self, sock, stop_event):
+    def send(self, text):
+        if self.framing is not None:
+            data = encode_frame(MESSAGE, payload=text)
+        else:
+            data = (text + "\n").encode("utf-8")
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def heartbeat_thread(self, lost):
+        # Keeps the server from reaping a connection whose user is just reading
+        while not lost.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.send(PING_COMMAND)
+            except OSError:
+                lost.set()
+
+    def writing_thread(self, stop_event):
 
         while not stop_event.is_set():
-            user_input = input(f"[{self.username}]: ")
+            try:
+                user_input = input(f"[{self.username}]: ")
+            except EOFError:
+                user_input = "exit"
 
             if user_input.lower() == "exit":
                 stop_event.set()
                 try:
-                    sock.shutdown(socket.SHUT_RDWR)
+                    self.sock.shutdown(socket.SHUT_RDWR)
                 except:
                     pass
                 break
 
-            sock.sendall(user_input.encode("utf-8"))
+            if user_input.lower() == "/older":
+                before = self.oldest_seen if self.oldest_seen is not None else "inf"
+                user_input = f"{HISTORY_COMMAND} {before} {PAGE_SIZE}"
 
-    def execute(self, sock):
+            try:
+                self.send(user_input)
+            except OSError:
+                print("Not connected, message not sent.")
 
-        try:
-            sock.connect((self.host, self.port))
-            print("Connected to server.\n")
-
-            sock.sendall(f"{self.username}--{self.recipient}".encode("utf-8"))
-
-            # -------- RECEIVE HISTORY FIRST --------
-            buffer = ""
-            while True:
-                chunk = sock.recv(4096).decode("utf-8")
-                buffer += chunk
-                if "HISTORY_END" in buffer:
-                    history, _ = buffer.split("HISTORY_END", 1)
-                    if history.strip():
-                        print(history)
-                    break
+    def connect(self, sock):
+        sock.connect((self.host, self.port))
+        print("Connected to server.\n")
+
+        # After a reconnect only the messages missed in between are replayed
+        since = f"since={self.last_seen if self.last_seen is not None else ''}"
+        if self.framed:
+            self.framing = FrameDecoder()
+            sock.sendall(MAGIC + encode_frame(HELLO, self.username, self.recipient, since))
+            self.receive_framed_history(sock)
+        else:
+            self.lines = LineDecoder(errors="replace")
+            sock.sendall(f"{self.username}--{self.recipient}--{since}\n".encode("utf-8"))
+            self.receive_text_history(sock)
 
-            stop_event = threading.Event()
-            threading.Thread(target=self.reading_thread, args=(sock, stop_event), daemon=True).start()
-            threading.Thread(target=self.writing_thread, args=(sock, stop_event), daemon=True).start()
+    def execute(self):
+        """Stay connected until the user exits, reconnecting when the connection drops or the server moves us."""
+        stop_event = threading.Event()
+        connected = False
+        attempt = 0
+        while not stop_event.is_set():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.lost = lost = threading.Event()
+            self.moving = False
+            try:
+                self.connect(sock)
+            except OSError:
+                sock.close()
+                attempt += 1
+                if not connected or attempt > MAX_RECONNECT_ATTEMPTS:
+                    print("Could not connect to server.")
+                    return
+                delay = backoff(attempt)
+                print(f"Could not connect to server, retrying in {delay:.1f}s")
+                stop_event.wait(delay)
+                continue
 
-            while not stop_event.is_set():
-                stop_event.wait(1)
+            self.sock = sock
+            attempt = 0
+            threading.Thread(target=self.reading_thread, args=(sock, lost), daemon=True).start()
+            threading.Thread(target=self.heartbeat_thread, args=(lost,), daemon=True).start()
+            if not connected:
+                threading.Thread(target=self.writing_thread, args=(stop_event,), daemon=True).start()
+                connected = True
 
+            while not stop_event.is_set() and not lost.is_set():
+                lost.wait(1)
+            # The reading thread is still blocked in recv, and close alone
+            # would not end the connection under it
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             sock.close()
 
-        except ConnectionRefusedError:
-            print("Could not connect to server.")
+            if not stop_event.is_set() and not self.moving:
+                delay = backoff(1)
+                print(f"\rConnection lost, reconnecting in {delay:.1f}s")
+                stop_event.wait(delay)
 
-    def __str__(self):
-        return f"IP: {self.host}\nPort: {self.port}\nUsername: {self.username}\nRecipient: {self.recipient}"
+    def receive_text_history(self, sock):
+        output = []
+        while True:
+            if self.lines.recv_into(sock) == 0:
+                raise ConnectionResetError("Server closed the connection")
+            for line in self.lines.lines():
+                output.append(line + "\n")
+                if line == "HISTORY_END":
+                    # Anything after it in the same read is live traffic
+                    output.extend(self.text_line(live) for live in self.lines.lines())
+                    history = self.unstamp("".join(output))
+                    if history.strip():
+                        print(history)
+                    return
 
+    def receive_framed_history(self, sock):
+        output = []
+        while True:
+            if self.framing.recv_into(sock) == 0:
+                raise ConnectionResetError("Server closed the connection")
+            for frame in self.framing.frames():
+                output.append(render_frame(*frame))
+                if frame[0] == HISTORY_END:
+                    # Anything after it in the same read is live traffic
+                    for live in self.framing.frames():
+                        output.append(self.render(live))
+                    history = self.unstamp("".join(output))
+                    if history.strip():
+                        print(history)
+                    return
 
-def main():
-    if len(sys.argv) < 4:
-        print("Usage: python3 chat_client.py <server_ip> <port> <username> [recipient]")
-        return
+    def __str__(self):
+        return (f"IP: {self.host}\nPort: {self.port}\nUsername: {self.username}\nRecipient: {self.recipient}"
+                f"\nProtocol: {'framed' if self.framed else 'text'}")
 
-    client = ChatClient(sys.argv[1], sys.argv[2], sys.argv[3])
 
-    if len(sys.argv) == 5:
-        client.recipient = sys.argv[4]
-    else:
-        client.recipient = "BROADCAST"
+def main():
+    parser = argparse.ArgumentParser(description="Chat client")
+    parser.add_argument("server_ip")
+    parser.add_argument("port")
+    parser.add_argument("username")
+    parser.add_argument("recipient", nargs="?", default="BROADCAST")
+    parser.add_argument("--framed", action="store_true",
+                        help="Use the length-prefixed binary protocol instead of newline text")
+    args = parser.parse_args()
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client = ChatClient(args.server_ip, args.port, args.username)
+    client.recipient = args.recipient
+    client.framed = args.framed
 
     print("Type 'exit' to quit.\n")
     print("--- Client config ---")
     print(client)
 
-    client.execute(sock)
+    client.execute()
 
 
 if __name__ == "__main__":
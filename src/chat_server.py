@@ -1,66 +1,774 @@
-import sys
 import socket
+import signal
 import threading
 import redis
 import os
-import json
+import time
+import random
+import secrets
+import argparse
+import tempfile
+import unicodedata
+import multiprocessing
+import multiprocessing.connection
+
+from fanout import RedisFanout
+from history_cache import HistoryCache
+from history_record import ENCODERS, HISTORY_FORMATS, decode_line, history_line
+from outbound import OutboundQueue, OutboundStats, OVERFLOW_POLICIES
+from persistence import MessageWriter, PERSISTENCE_MODES
+from retention import HistoryRetention, SegmentArchive
+from ratelimit import ConnectLimiter, RoomLimiter, TokenBucket
+from metrics import ChatMetrics, start_metrics_server
+from profiling import Instrumentation
+from protocol import (
+    MAGIC, HELLO, MESSAGE, HISTORY, HISTORY_END, RECONNECT, RECONNECT_LINE, HISTORY_COMMAND, JOIN_COMMAND,
+    LEAVE_COMMAND, PING_COMMAND, ROOM_PREFIX, MAX_NAME, FrameDecoder, LineDecoder, ProtocolError, encode_frame, is_room,
+    parse_since, stamp
+)
+
+ENGINES = ("threads", "asyncio")
+TCP_MODES = ("nodelay", "nagle", "cork")
+
+
+def redis_options():
+    return dict(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", 6379)),
+        username=os.getenv("REDIS_USER", None),
+        password=os.getenv("REDIS_PASSWORD", None),
+        db=int(os.getenv("REDIS_DB", 0)),
+        decode_responses=True
+    )
+
+
+LEGACY_HISTORY_KEY = "chat_history"
+HISTORY_LIMIT = 1000
+HISTORY_PAGE = 50
+# Entries read per LRANGE while looking for an older page
+HISTORY_PAGE_SCAN = 500
+# Longest unterminated text handshake accepted
+MAX_HANDSHAKE = 1024
+# Longest line or frame body a client may send; a connection that sends
+# more is dropped instead of buffering it (protocol.MAX_FRAME is for the
+# server's history frames)
+MAX_MESSAGE = 64 << 10
+
+
+def history_key(username, recipient):
+    # One list per conversation: the broadcast room, a named room, or the
+    # sorted user pair for a DM so both sides read and write the same key.
+    # "--" cannot appear in a username since it separates the handshake fields.
+    if recipient == "BROADCAST":
+        return "chat_history:BROADCAST"
+    if is_room(recipient):
+        return "chat_history:room:" + recipient[len(ROOM_PREFIX):]
+    return "chat_history:dm:" + "--".join(sorted((username, recipient)))
+
+
+def history_entries(history):
+    """Parse raw history into (ts, rendered line) pairs; ts is None for entries older than timestamps."""
+    entries = []
+    for raw in history:
+        entry = decode_line(raw)
+        if entry is not None:
+            entries.append(entry)
+    return entries
+
+
+def with_unwritten(raw, unwritten):
+    """Append the write-behind entries that are not in raw yet, keeping the last HISTORY_LIMIT."""
+    stored = set(raw)
+    return (raw + [entry for entry in unwritten if entry not in stored])[-HISTORY_LIMIT:]
+
+
+def entries_since(entries, since):
+    if not since:
+        return entries
+    return [(ts, line) for ts, line in entries if ts is not None and ts > since]
+
+
+class Connection:
+    """Per-connection state, shared by both engines.
+
+    ``stream`` is the socket (threads) or StreamWriter (asyncio) and
+    ``framing`` the FrameDecoder, None for the text protocol. ``recipient``
+    is the one named in the handshake; ``target`` is where messages without
+    an explicit recipient go, which is the room joined last, if any.
+    ``session`` tells a user's successive connections apart in the log and
+    ``last_active`` is when the client last sent anything. ``bucket`` is
+    the connection's TokenBucket under --message-rate, if any.
+    """
+
+    __slots__ = (
+        "stream", "recipient", "outbound", "framing", "stamped", "target", "rooms", "session", "last_active",
+        "bucket"
+    )
+
+    def __init__(self, stream, recipient, outbound, framing=None, stamped=False):
+        self.stream = stream
+        self.recipient = recipient
+        self.outbound = outbound
+        self.framing = framing
+        self.stamped = stamped
+        self.target = recipient
+        self.rooms = set()
+        self.session = secrets.token_hex(6)
+        self.last_active = time.monotonic()
+        self.bucket = None
+
+
+class MessageClock:
+    """Wall-clock timestamps with microsecond resolution, strictly increasing within this process."""
+
+    def __init__(self):
+        self.last = 0.0
+        self.lock = threading.Lock()
+
+    def now(self):
+        with self.lock:
+            self.last = max(round(time.time(), 6), round(self.last + 0.000001, 6))
+            return self.last
+
+
+def broadcast_frame(push_msg):
+    return ("\\BROADCAST/" + push_msg + "\n").encode("utf-8")
+
+
+def direct_frame(push_msg):
+    return (push_msg + "\n").encode("utf-8")
+
+
+def room_frame(room, push_msg):
+    return ("\\" + room + "/" + push_msg + "\n").encode("utf-8")
+
+
+def encode_message(framing, username, recipient, message, ts=None):
+    # ts is only passed for stamped connections
+    prefix = stamp(ts) if ts is not None else ""
+    if framing is not None:
+        return encode_frame(MESSAGE, username, recipient, prefix + message)
+    push_msg = f"[{username}]: {message}"
+    if recipient == "BROADCAST":
+        return prefix.encode("utf-8") + broadcast_frame(push_msg)
+    if is_room(recipient):
+        return prefix.encode("utf-8") + room_frame(recipient, push_msg)
+    return direct_frame(prefix + push_msg)
+
+
+def encode_history(framing, entries, stamped=False):
+    if stamped:
+        lines = [line if ts is None else stamp(ts) + line for ts, line in entries]
+    else:
+        lines = [line for _, line in entries]
+    if framing is not None:
+        return encode_frame(HISTORY, payload="".join(lines)) + encode_frame(HISTORY_END)
+    return ("".join(lines) + "HISTORY_END\n").encode("utf-8")
+
+
+def enable_keepalive(sock, idle):
+    """Have the kernel probe a peer that has been silent for idle seconds and reset the connection if it is gone."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle)))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(idle) // 6))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+
+def encode_reconnect(framing, delay_ms):
+    if framing is not None:
+        return encode_frame(RECONNECT, payload=str(delay_ms))
+    return f"{RECONNECT_LINE} {delay_ms}\n".encode("utf-8")
+
+
+class Draining(Exception):
+    """Raised on the accept loop by SIGTERM to switch the threaded server to draining."""
+
+
+def set_tcp_mode(sock, mode):
+    """Apply --tcp-mode to an accepted socket; cork falls back to nodelay where TCP_CORK does not exist."""
+    if mode == "cork" and hasattr(socket, "TCP_CORK"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        return
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0 if mode == "nagle" else 1)
+
+
+def uncork(sock):
+    # Sends the partial packet a corked socket is holding back, then corks it again
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
+
+def valid_name(name):
+    """A username or recipient must be non-empty, fit in a frame header and fit on one line of the text protocol."""
+    # Control characters and every str.splitlines separator (U+2028...)
+    # would let a name forge or break lines for text clients; a longer
+    # name could not be sent to framed clients
+    if not name or len(name.encode("utf-8")) > MAX_NAME:
+        return False
+    return "".join(name.splitlines()) == name and not any(
+        unicodedata.category(c) == "Cc" for c in name
+    )
+
+
+def valid_room(room):
+    return (is_room(room) and len(room) > len(ROOM_PREFIX) and valid_name(room)
+            and not any(c.isspace() for c in room))
+
+
+def text_handshake(lines):
+    """Return the handshake from a text connection's LineDecoder, or None until it has fully arrived.
+
+    The handshake is the first line; anything after it stays buffered as
+    the connection's first messages. Clients that never send a newline
+    write the handshake on its own, so an unterminated one is taken whole
+    once both of its fields are there.
+    """
+    for line in lines.lines():
+        return line
+    fields = lines.peek_tail().split(b"--")
+    if len(fields) >= 2 and fields[0] and fields[1]:
+        return lines.take_tail()
+    if lines.pending() > MAX_HANDSHAKE:
+        raise ProtocolError(f"Handshake exceeds {MAX_HANDSHAKE} bytes")
+    return None
+
+
+def valid_sender_recipient(username, recipient):
+    """The handshake rules shared by both protocols: valid names, no room as the username."""
+    if not valid_name(username) or not valid_name(recipient) or is_room(username):
+        return False
+    return not is_room(recipient) or valid_room(recipient)
+
+
+def parse_handshake(handshake):
+    """Return (username, recipient, since) from a "username--recipient[--options]" handshake."""
+    fields = handshake.strip().split('--')
+    if len(fields) < 2 or not fields[0] or not fields[1]:
+        raise ProtocolError("Expected a username--recipient handshake")
+    if not valid_sender_recipient(fields[0], fields[1]):
+        raise ProtocolError(f"Invalid handshake: {fields[0]!r}--{fields[1]!r}")
+    since = parse_since(fields[2]) if len(fields) > 2 else None
+    return fields[0], fields[1], since
+
+
+def parse_hello(framing):
+    """Return (username, recipient, since) from the HELLO frame, or None if it has not fully arrived."""
+    for frame_type, sender, recipient, payload in framing.frames():
+        if frame_type != HELLO:
+            raise ProtocolError("Expected a HELLO frame")
+        if not valid_sender_recipient(sender, recipient):
+            raise ProtocolError(f"Invalid HELLO: {sender!r}--{recipient!r}")
+        return sender, recipient, parse_since(payload)
+    return None
+
+
+def parse_history_request(message):
+    """Return (before, limit) for a "/history [<before>] [<limit>]" message, or None for chat text."""
+    fields = message.split()
+    if not fields or fields[0] != HISTORY_COMMAND:
+        return None
+    try:
+        before = float(fields[1]) if len(fields) > 1 else float("inf")
+        limit = int(fields[2]) if len(fields) > 2 else HISTORY_PAGE
+    except ValueError:
+        return float("inf"), HISTORY_PAGE
+    return before, max(1, min(limit, HISTORY_LIMIT))
+
+
+def parse_room_command(message):
+    """Return (command, room) for a "/join" or "/leave" message, or None for chat text.
+
+    room is None when it is missing or not a valid room name.
+    """
+    fields = message.split()
+    if not fields or fields[0] not in (JOIN_COMMAND, LEAVE_COMMAND):
+        return None
+    room = fields[1] if len(fields) == 2 and valid_room(fields[1]) else None
+    return fields[0], room
+
+
+def text_messages(lines):
+    """Return the (recipient, message) pairs for the complete lines in a text connection's LineDecoder."""
+    messages = [(None, line) for line in lines.lines() if line]
+    if not lines.seen_newline and lines.pending():
+        # Clients that never end a message with a newline send one per write
+        messages.append((None, lines.take_tail()))
+    return messages
+
+
+def framed_messages(framing):
+    """Return the (recipient, message) pairs for the complete MESSAGE frames in a framed connection's FrameDecoder.
+
+    Text clients and stored history are line based, so line breaks inside
+    a message become spaces; otherwise a framed sender could forge whole
+    lines (another user's message, a RECONNECT) for text clients.
+    """
+    return [
+        (frame_recipient or None, " ".join(payload.splitlines()))
+        for frame_type, _, frame_recipient, payload in framing.frames()
+        if frame_type == MESSAGE and payload and (not frame_recipient or valid_name(frame_recipient))
+    ]
+
+
+def buffered_messages(framing, lines):
+    """Return the (recipient, message) pairs buffered in a connection's decoder, or None if the client broke the protocol."""
+    try:
+        return text_messages(lines) if framing is None else framed_messages(framing)
+    except (UnicodeDecodeError, ProtocolError):
+        return None
+
+
+def older_than(entries, before):
+    # Entries without a timestamp predate every stamped one
+    return [(ts, line) for ts, line in entries if (ts or 0) < before]
+
+
+def make_retention(client, history_cache, max_entries, max_age_hours, archive_dir):
+    if not max_entries and not max_age_hours:
+        return None
+
+    def trimmed(key, remaining):
+        # Lines the cache still holds may be gone from Redis now
+        if history_cache is not None and remaining < HISTORY_LIMIT:
+            history_cache.invalidate(key)
+
+    archive = SegmentArchive(archive_dir) if archive_dir else None
+    return HistoryRetention(client, max_entries, max_age_hours * 3600, archive, trimmed)
+
 
 class ChatServer:
-    def __init__(self, port):
+    engine = "threads"
+    outbound_class = OutboundQueue
+
+    def __init__(self, port, fanout=False, outbound_queue=1024, overflow_policy="disconnect",
+                 history_cache_mb=8, persistence="async", persist_batch=128, persist_interval_ms=5,
+                 redis_factory=None, metrics_port=0, retention_max_entries=0, retention_max_age_hours=0,
+                 archive_dir=None, backlog=1024, handshake_timeout=10, connect_rate=0, connect_burst=20,
+                 idle_timeout=0, keepalive=60, history_format="compact", flush_window_ms=0, flush_bytes=65536,
+                 tcp_mode="nodelay", message_rate=0, message_burst=20, room_rate=0, room_burst=100,
+                 drain_timeout=20, profile_dir=None):
         self.port = int(port)
         self.connections = {}
+        # room -> {username: Connection} for the local members; guarded by connections_lock
+        self.rooms = {}
+        # Connections whose handler is still running, registered or not;
+        # guarded by connections_lock
+        self.open_sessions = 0
+        self.backlog = backlog
+        self.handshake_timeout = handshake_timeout
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.drain_timeout = drain_timeout
+        self.draining = False
+        self.connect_limiter = ConnectLimiter(connect_rate, connect_burst) if connect_rate > 0 else None
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.room_limiter = RoomLimiter(room_rate, room_burst) if room_rate > 0 else None
         self.connections_lock = threading.Lock()
-        self.redis = redis.Redis(
-            host=os.getenv("REDIS_HOST", "localhost"),
-            port=int(os.getenv("REDIS_PORT", 6379)),
-            username=os.getenv("REDIS_USER", None),
-            password=os.getenv("REDIS_PASSWORD", None),
-            db=int(os.getenv("REDIS_DB", 0)),
-            decode_responses=True
-        )
-    
-    def save_message(self, username, recipient, message):
-        msg_obj = {
-            "sender": username,
-            "recipient": recipient,
-            "message": message
-        }
-        self.redis.rpush("chat_history", json.dumps(msg_obj))
-                
-
-    def send_history(self, connection, username, recipient):
-        history = self.redis.lrange("chat_history", -1000, -1)
-        
+        self.clock = MessageClock()
+        self.metrics = ChatMetrics(self)
+        self.instrumentation = Instrumentation(profile_dir or tempfile.gettempdir())
+        self.tracer = self.instrumentation.tracer
+        self.metrics_port = metrics_port
+        self.redis_factory = redis_factory or (lambda: redis.Redis(**redis_options()))
+        self.redis = self.handler_redis()
+        self.fanout = None
+        if fanout:
+            self.fanout = RedisFanout(self.redis_factory(), self.deliver_remote, tracer=self.tracer)
+        self.encode_entry = ENCODERS[history_format]
+        self.persistence = persistence
+        self.message_writer = None
+        if persistence != "direct":
+            # Sync senders are blocked on their ack, so a sync batch is
+            # flushed as soon as the flusher is free instead of on a timer
+            flush_interval = persist_interval_ms / 1000 if persistence == "async" else 0
+            self.message_writer = MessageWriter(
+                self.redis_factory(), persist_batch, flush_interval, tracer=self.tracer
+            )
+        self.outbound_queue = outbound_queue
+        self.overflow_policy = overflow_policy
+        self.outbound_stats = OutboundStats()
+        self.flush_window = flush_window_ms / 1000
+        self.flush_bytes = flush_bytes
+        self.tcp_mode = tcp_mode
+        self.corked = tcp_mode == "cork" and hasattr(socket, "TCP_CORK")
+        self.history_cache = None
+        if history_cache_mb > 0:
+            self.history_cache = HistoryCache(HISTORY_LIMIT, history_cache_mb << 20)
+        self.retention = make_retention(self.redis_factory(), self.history_cache, retention_max_entries,
+                                        retention_max_age_hours, archive_dir)
+
+    def add_connection(self, username, connection, recipient, framing=None, stamped=False):
+        # framing is the connection's FrameDecoder, or None for the text protocol;
+        # stamped connections get every stored message prefixed with its ID
+        outbound = self.outbound_class(self.outbound_queue, self.overflow_policy, self.outbound_stats,
+                                       window=self.flush_window, flush_bytes=self.flush_bytes)
+        conn_data = Connection(connection, recipient, outbound, framing, stamped)
+        if self.message_rate > 0:
+            conn_data.bucket = TokenBucket(self.message_rate, self.message_burst)
+        with self.connections_lock:
+            previous = self.connections.get(username)
+            self.connections[username] = conn_data
+            self.open_sessions += 1
+            emptied = []
+            if previous is not None:
+                emptied = [room for room in list(previous.rooms) if self.remove_member(username, previous, room)]
+            if is_room(recipient):
+                self.add_member(username, conn_data, recipient)
+            emptied = [room for room in emptied if room not in self.rooms]
+        for room in emptied:
+            self.room_emptied(room)
+        if self.fanout is not None:
+            self.fanout.subscribe_user(username)
+        if previous is not None:
+            # A reconnect takes over: the old socket is closed so its
+            # handler exits instead of lingering until the peer times out
+            print(f"[{username}] session {previous.session} taken over by {conn_data.session}")
+            self.metrics.sessions_reaped.inc(reason="taken_over")
+            previous.outbound.close()
+            self.abort(previous)
+        return conn_data
+
+    def close_session(self, username, conn_data):
+        """Unregister a connection whose handler is exiting; return True if it was still the user's current one."""
+        with self.connections_lock:
+            self.open_sessions -= 1
+            current = self.connections.get(username) is conn_data
+        self.drop_connection(username, conn_data)
+        return current
+
+    def abort(self, conn_data):
+        # Ends the connection's reader and writer; its handler cleans up
         try:
-            for raw in history:
-                try:
-                    entry = json.loads(raw)
-                except json.JSONDecodeError:
-                    continue
+            conn_data.stream.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def idle_connections(self):
+        deadline = time.monotonic() - self.idle_timeout
+        with self.connections_lock:
+            return [
+                (username, conn_data) for username, conn_data in self.connections.items()
+                if conn_data.last_active < deadline
+            ]
+
+    def reap_idle(self):
+        for username, conn_data in self.idle_connections():
+            print(f"[{username}] session {conn_data.session} reaped: idle for {self.idle_timeout:g}s")
+            self.metrics.sessions_reaped.inc(reason="idle")
+            self.abort(conn_data)
+
+    def send_reconnects(self):
+        """Ask every connection to reconnect after a random delay in the first half of the drain; return how many."""
+        with self.connections_lock:
+            connections = list(self.connections.items())
+        spread_ms = int(self.drain_timeout * 500)
+        for username, conn_data in connections:
+            self.enqueue(username, conn_data, encode_reconnect(conn_data.framing, random.randint(0, spread_ms)))
+        return len(connections)
+
+    def close_all(self):
+        with self.connections_lock:
+            remaining = list(self.connections.values())
+        for conn_data in remaining:
+            self.abort(conn_data)
+        if remaining:
+            print(f"Closed {len(remaining)} connections that did not reconnect")
+
+    def request_drain(self, signum=None, frame=None):
+        # SIGTERM handler: signals are handled on the main thread, which is
+        # blocked in the accept loop
+        if self.draining:
+            raise KeyboardInterrupt
+        self.draining = True
+        raise Draining
+
+    def drain(self):
+        """Let clients move away a few at a time, instead of all at once when the process exits."""
+        count = self.send_reconnects()
+        print(f"Draining: asked {count} connections to reconnect within {self.drain_timeout / 2:g}s")
+        deadline = time.monotonic() + self.drain_timeout
+        while self.connections and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self.close_all()
+
+    def reaper_thread(self):
+        while True:
+            time.sleep(self.idle_timeout / 4)
+            self.reap_idle()
+
+    def drop_connection(self, username, conn_data=None):
+        with self.connections_lock:
+            current = self.connections.get(username)
+            if current is not None and (conn_data is None or current is conn_data):
+                del self.connections[username]
+                conn_data = current
+            else:
+                current = None
+            # A connection replaced by a newer one for the same user still
+            # has to leave its rooms
+            emptied = []
+            if conn_data is not None:
+                emptied = [room for room in list(conn_data.rooms) if self.remove_member(username, conn_data, room)]
+        for room in emptied:
+            self.room_emptied(room)
+        if current is None:
+            return
+        current.outbound.close()
+        if self.fanout is not None:
+            self.fanout.unsubscribe_user(username)
+            self.forget_history(username, current.recipient)
+
+    def forget_history(self, username, recipient):
+        # This replica only sees a DM channel's traffic while one side of it
+        # is connected here, so its cached copy goes stale after that
+        if self.history_cache is not None and recipient != "BROADCAST" and not is_room(recipient):
+            self.history_cache.invalidate(history_key(username, recipient))
+
+    def add_member(self, username, conn_data, room):
+        # Callers hold connections_lock
+        members = self.rooms.setdefault(room, {})
+        if not members and self.fanout is not None:
+            self.fanout.subscribe_room(room)
+        members[username] = conn_data
+        conn_data.rooms.add(room)
 
-                sender = entry["sender"]
-                rec = entry["recipient"]
-                msg = entry["message"]
-
-                # Broadcast messages
-                if recipient == "BROADCAST" and rec == "BROADCAST":
-                    connection.sendall(
-                        f"[{sender}]:[{rec}] {msg}\n".encode("utf-8")
-                    )
-                # Private 1:1 channel
-                elif rec == recipient and sender == username:
-                    connection.sendall(
-                        f"[{sender}]:[{rec}] {msg}\n".encode("utf-8")
-                    )
-                elif rec == username and sender == recipient:
-                    connection.sendall(
-                        f"[{sender}]:[{rec}] {msg}\n".encode("utf-8")
-                    )
-
-            connection.sendall("HISTORY_END\n".encode("utf-8"))
-
-        except (OSError, BrokenPipeError, ConnectionResetError):
+    def remove_member(self, username, conn_data, room):
+        """Remove the membership; return True if that left the room without local members. Callers hold connections_lock."""
+        conn_data.rooms.discard(room)
+        members = self.rooms.get(room)
+        if members is None or members.get(username) is not conn_data:
+            return False
+        del members[username]
+        if members:
+            return False
+        del self.rooms[room]
+        return True
+
+    def room_emptied(self, room):
+        # Like a DM channel, a room's traffic only reaches this replica while
+        # it has a local member
+        if self.fanout is not None:
+            self.fanout.unsubscribe_room(room)
+            if self.history_cache is not None:
+                self.history_cache.invalidate(history_key(None, room))
+
+    def join_room(self, username, conn_data, room):
+        with self.connections_lock:
+            self.add_member(username, conn_data, room)
+            conn_data.target = room
+
+    def leave_room(self, username, conn_data, room):
+        with self.connections_lock:
+            emptied = self.remove_member(username, conn_data, room)
+            if conn_data.target == room:
+                conn_data.target = conn_data.recipient if not is_room(conn_data.recipient) else "BROADCAST"
+        if emptied:
+            self.room_emptied(room)
+
+    def notify(self, username, conn_data, text):
+        # A server notice for this connection only
+        self.enqueue(username, conn_data, encode_message(conn_data.framing, "server", username, text))
+
+    def message_failed(self, username, conn_data, error):
+        # Only the message is lost; the connection stays up
+        print(f"[{username}] message failed: {error}")
+        self.metrics.messages_failed.inc()
+        self.notify(username, conn_data, "Message not sent, please try again")
+
+    def connection_delay(self, conn_data):
+        """Seconds this connection must pause before its next message, under --message-rate."""
+        if conn_data.bucket is None:
+            return 0
+        delay = conn_data.bucket.reserve()
+        if delay:
+            self.metrics.rate_limited.inc(scope="connection")
+            self.metrics.rate_limited_seconds.inc(delay, scope="connection")
+        return delay
+
+    def room_delay(self, recipient):
+        """Seconds a message to recipient must wait under --room-rate; BROADCAST counts as a room."""
+        if self.room_limiter is None or not (recipient == "BROADCAST" or is_room(recipient)):
+            return 0
+        delay = self.room_limiter.reserve(recipient)
+        if delay:
+            self.metrics.rate_limited.inc(scope="room")
+            self.metrics.rate_limited_seconds.inc(delay, scope="room")
+        return delay
+
+    def queue_stats(self):
+        with self.connections_lock:
+            depths = {name: conn_data.outbound.depth for name, conn_data in self.connections.items()}
+        stats = self.outbound_stats.snapshot()
+        stats["queue_depth"] = depths
+        return stats
+
+    def enqueue(self, connection_name, conn_data, data):
+        accepted = conn_data.outbound.put(data)
+        if accepted or accepted is None:
+            # None: closed already, by a takeover or an earlier drop, and
+            # the connection is being torn down
+            return
+
+        # Slow consumer: its queue overflowed under the disconnect policy
+        print(f"[{connection_name}] disconnected: outbound queue full")
+        self.drop_connection(connection_name, conn_data)
+        self.abort(conn_data)
+
+    def writer_thread(self, username, conn_data):
+        connection, outbound = conn_data.stream, conn_data.outbound
+        while True:
+            data = outbound.get()
+            if data is None:
+                return
+            try:
+                connection.sendall(data)
+                if self.corked:
+                    uncork(connection)
+            except (OSError, BrokenPipeError, ConnectionResetError):
+                self.drop_connection(username, conn_data)
+                return
+            self.metrics.send_batch_frames.observe(outbound.batch)
+            self.metrics.send_batch_bytes.observe(len(data))
+    
+    def save_message(self, username, recipient, message, ts):
+        key = history_key(username, recipient)
+        entry = self.encode_entry(username, recipient, message, ts)
+        if self.retention is not None:
+            self.retention.touch(key)
+        with self.metrics.save_latency.time(), self.tracer.span("save"):
+            try:
+                if self.message_writer is None:
+                    with self.tracer.span("redis"):
+                        self.redis.rpush(key, entry)
+                    self.cache_message(username, recipient, message, ts)
+                    return
+
+                ack = self.queue_message(key, username, recipient, message, entry, ts)
+                if self.persistence == "sync":
+                    with self.tracer.span("ack"):
+                        ack.result()
+            except redis.RedisError:
+                self.metrics.redis_errors.inc(operation="save_message")
+                raise
+
+    def queue_message(self, key, username, recipient, message, raw, ts):
+        ack = self.message_writer.save(key, raw)
+        # Cached at once, so a replay that starts before the flush still has
+        # it; a concurrent cold load is marked stale by the append, and loads
+        # from Redis add the unwritten entries (see load_history)
+        self.cache_message(username, recipient, message, ts)
+
+        def written(ack):
+            # The cache must not keep what Redis never got
+            if not ack.cancelled() and ack.exception() is not None and self.history_cache is not None:
+                self.history_cache.invalidate(key)
+
+        ack.add_done_callback(written)
+        return ack
+
+    def cache_message(self, username, recipient, message, ts):
+        if self.history_cache is not None:
+            self.history_cache.append(
+                history_key(username, recipient), (ts, history_line(username, recipient, message))
+            )
+
+    def load_history(self, key):
+        token = None
+        if self.history_cache is not None:
+            entries = self.history_cache.get(key)
+            if entries is not None:
+                return entries
+            token = self.history_cache.start_load(key)
+        # Taken before the read: an entry flushed in between is then in
+        # both, and one queued after it marks the load stale
+        unwritten = self.message_writer.unwritten(key) if self.message_writer is not None else []
+
+        try:
+            with self.tracer.span("redis"):
+                raw = self.redis.lrange(key, -HISTORY_LIMIT, -1)
+        except redis.RedisError:
+            self.metrics.redis_errors.inc(operation="load_history")
             raise
+        if unwritten:
+            raw = with_unwritten(raw, unwritten)
+        with self.tracer.span("decode"):
+            entries = history_entries(raw)
+        if token is not None:
+            self.history_cache.fill(key, entries, token)
+        return entries
+
+    def load_page(self, key, before, limit):
+        """The newest limit entries older than before, scanning back from the end of the list."""
+        page = []
+        end = -1
+        while len(page) < limit:
+            chunk = self.redis.lrange(key, end - HISTORY_PAGE_SCAN + 1, end)
+            page = older_than(history_entries(chunk), before) + page
+            if len(chunk) < HISTORY_PAGE_SCAN:
+                break
+            end -= HISTORY_PAGE_SCAN
+        return page[-limit:]
+
+    def send_history(self, connection, username, recipient, framing=None, since=None):
+        with self.metrics.history_latency.time(), self.tracer.span("history"):
+            entries = entries_since(self.load_history(history_key(username, recipient)), since)
+
+            # Replay the whole history and HISTORY_END in a single write
+            with self.tracer.span("send"):
+                connection.sendall(encode_history(framing, entries, stamped=since is not None))
+
+    def send_page(self, username, conn_data, before, limit):
+        # Queued behind any live messages, like every other write after the replay
+        entries = self.load_page(history_key(username, conn_data.target), before, limit)
+        self.enqueue(username, conn_data, encode_history(conn_data.framing, entries, stamped=True))
+
+    def send_room_history(self, username, conn_data, room):
+        # Queued like a page, so live messages from the moment of joining may precede it
+        entries = self.load_history(history_key(username, room))
+        self.enqueue(username, conn_data, encode_history(conn_data.framing, entries, stamped=conn_data.stamped))
+
+    def handle_message(self, username, conn_data, recipient, message):
+        """Run a command, or push a chat message to recipient (the connection's target if None)."""
+        if message.strip() == PING_COMMAND:
+            return
+
+        # Over a limit the reader sleeps instead of queueing, so the client
+        # is held back by TCP flow control
+        delay = self.connection_delay(conn_data)
+        if delay:
+            with self.tracer.span("rate_limit"):
+                time.sleep(delay)
+
+        request = parse_history_request(message) if conn_data.stamped else None
+        if request is not None:
+            self.send_page(username, conn_data, *request)
+            return
+
+        command = parse_room_command(message)
+        if command is not None:
+            command, room = command
+            if room is None:
+                self.notify(username, conn_data, f"Usage: {command} {ROOM_PREFIX}<room>")
+            elif command == JOIN_COMMAND:
+                self.join_room(username, conn_data, room)
+                self.send_room_history(username, conn_data, room)
+                self.push("server", room, f"[{username}] joined {room}")
+            else:
+                self.leave_room(username, conn_data, room)
+                self.push("server", room, f"[{username}] left {room}")
+            return
+
+        recipient = recipient or conn_data.target
+        if is_room(recipient) and recipient not in conn_data.rooms:
+            self.notify(username, conn_data, f"Join {recipient} before sending to it")
+            return
+        delay = self.room_delay(recipient)
+        if delay:
+            with self.tracer.span("rate_limit"):
+                time.sleep(delay)
+        self.push(username, recipient, message)
 
     def push(self, username, recipient, message):
 
@@ -68,123 +776,480 @@ class ChatServer:
             return
         
         message = message.rstrip("\n")
-        push_msg = f"[{username}]: {message}"
 
+        ts = None
         if username != "server":
-            self.save_message(username, recipient, message)
+            self.metrics.messages_in.inc()
+            ts = self.clock.now()
+            self.save_message(username, recipient, message, ts)
+
+        with self.tracer.span("deliver"):
+            delivered = self.deliver_local(username, recipient, message, ts)
+
+        # Other replicas only need a DM when the recipient is not connected here
+        if self.fanout is not None and (recipient == "BROADCAST" or is_room(recipient) or not delivered):
+            self.fanout.publish(username, recipient, message, ts)
 
+    def handler_redis(self):
+        """The Redis client the connection handlers use."""
+        return self.redis_factory()
+
+    def deliver_remote(self, username, recipient, message, ts=None):
+        # Called on the fanout subscriber thread
+        self.receive_remote(username, recipient, message, ts)
+
+    def receive_remote(self, username, recipient, message, ts=None):
+        # Another replica already saved it; keep the local cache in step
+        if username != "server":
+            self.cache_message(username, recipient, message, ts)
+        with self.tracer.span("deliver"):
+            self.deliver_local(username, recipient, message, ts)
+
+    def deliver_local(self, username, recipient, message, ts=None):
+        # ts is None for messages that are not stored (server notices)
         # Broadcast
         if recipient == "BROADCAST":
+            # Snapshot the recipients in one locked pass
             with self.connections_lock:
-                connection_keys = list(self.connections.keys())
-            
-            for connection_name in connection_keys:
-                if connection_name != username:
-                    with self.connections_lock:
-                        conn_data = self.connections.get(connection_name)
-                    
-                    if conn_data is not None:
-                        conn_socket = conn_data[0]
-                        try:
-                            conn_socket.sendall(
-                                ("\\BROADCAST/" + push_msg + "\n").encode("utf-8")
-                            )
-                        except (OSError, BrokenPipeError, ConnectionResetError):
-                            with self.connections_lock:
-                                if connection_name in self.connections:
-                                    del self.connections[connection_name]
-                            pass
+                recipients = [
+                    (connection_name, conn_data)
+                    for connection_name, conn_data in self.connections.items()
+                    if connection_name != username
+                ]
+            self.deliver_many(username, recipient, message, ts, recipients)
+            return True
+        elif is_room(recipient):
+            # Only the room's own members, through the index
+            with self.connections_lock:
+                recipients = [
+                    (connection_name, conn_data)
+                    for connection_name, conn_data in self.rooms.get(recipient, {}).items()
+                    if connection_name != username
+                ]
+            self.deliver_many(username, recipient, message, ts, recipients)
+            return True
         else:
             
             with self.connections_lock:
                 conn_data = self.connections.get(recipient)
             
             if conn_data is not None:
-                conn_socket = conn_data[0]
-                try:
-                    conn_socket.sendall((push_msg + "\n").encode("utf-8"))
-                except (OSError, BrokenPipeError, ConnectionResetError):
-                    with self.connections_lock:
-                        if recipient in self.connections:
-                            del self.connections[recipient]
-                    pass
-
-    def user_thread(self, username):
-        with self.connections_lock:
-            conn_data = self.connections.get(username)
-            if conn_data is None:
-                return
-            connection, recipient = conn_data
-        
+                self.metrics.messages_out.inc()
+                self.enqueue(recipient, conn_data, encode_message(
+                    conn_data.framing, username, recipient, message, ts if conn_data.stamped else None
+                ))
+                return True
+            return False
+
+    def deliver_many(self, username, recipient, message, ts, recipients):
+        # Encode once per protocol (and stamping); every queue of the same
+        # kind gets the same bytes object
+        self.metrics.fanout_size.observe(len(recipients))
+        self.metrics.messages_out.inc(len(recipients))
+
+        frames = {}
+        for connection_name, conn_data in recipients:
+            kind = (conn_data.framing is None, conn_data.stamped)
+            frame = frames.get(kind)
+            if frame is None:
+                frame = frames[kind] = encode_message(
+                    conn_data.framing, username, recipient, message, ts if conn_data.stamped else None
+                )
+            self.enqueue(connection_name, conn_data, frame)
+
+    def receive(self, connection, framing, lines=None):
+        """Return the (recipient, message) pairs from the next read, or None once the peer is gone.
+
+        A None recipient means the connection's own; framed clients may
+        address each message. Text connections pass their LineDecoder as
+        ``lines``; a read may end mid-line and return no messages.
+        """
+        try:
+            if (lines if framing is None else framing).recv_into(connection) == 0:
+                return None
+        except OSError:
+            return None
+        return buffered_messages(framing, lines)
+
+    def read_handshake(self, connection):
+        """Return (username, recipient, framing, since, lines); lines is the text connection's LineDecoder."""
+        data = connection.recv(1024)
+        while data and len(data) < len(MAGIC) and MAGIC.startswith(data):
+            data += connection.recv(1024)
+        if not data.startswith(MAGIC):
+            lines = LineDecoder(max_line=MAX_MESSAGE)
+            lines.feed(data)
+            handshake = text_handshake(lines)
+            while handshake is None:
+                if lines.recv_into(connection, 1024) == 0:
+                    raise ConnectionError("Connection closed during handshake")
+                handshake = text_handshake(lines)
+            username, recipient, since = parse_handshake(handshake)
+            return username, recipient, None, since, lines
+
+        framing = FrameDecoder(max_frame=MAX_MESSAGE)
+        framing.feed(data[len(MAGIC):])
+        while True:
+            hello = parse_hello(framing)
+            if hello is not None:
+                return hello[0], hello[1], framing, hello[2], None
+            if framing.recv_into(connection) == 0:
+                raise ConnectionError("Connection closed during handshake")
+
+    def admit(self, ip):
+        """Count an accepted connection; False if its address is over the connect rate limit."""
+        if self.connect_limiter is not None and not self.connect_limiter.allow(ip):
+            self.metrics.connections.inc(result="rate_limited")
+            return False
+        return True
+
+    def client_thread(self, connection):
+        # The handshake runs here rather than on the accept loop, so a client
+        # that connects and sends nothing only holds up its own thread
+        start = time.perf_counter()
         try:
-            self.send_history(connection, username, recipient)
+            connection.settimeout(self.handshake_timeout)
+            with self.tracer.span("handshake"):
+                username, recipient, framing, since, lines = self.read_handshake(connection)
+            connection.settimeout(None)
+            if self.keepalive:
+                enable_keepalive(connection, self.keepalive)
+            set_tcp_mode(connection, self.tcp_mode)
+        except socket.timeout:
+            self.metrics.connections.inc(result="timeout")
+            connection.close()
+            return
+        except (OSError, UnicodeDecodeError, ProtocolError):
+            self.metrics.connections.inc(result="invalid")
+            connection.close()
+            return
+        self.metrics.connections.inc(result="ok")
+        self.metrics.handshake_latency.observe(time.perf_counter() - start)
+
+        conn_data = self.add_connection(username, connection, recipient, framing, stamped=since is not None)
+        print(f"[{username}] connected (session {conn_data.session})")
+        try:
+            self.user_thread(username, conn_data, since, lines)
+        finally:
+            connection.close()
+
+    def user_thread(self, username, conn_data, since=None, lines=None):
+        connection, recipient, framing = conn_data.stream, conn_data.recipient, conn_data.framing
+
+        try:
+            self.send_history(connection, username, recipient, framing, since)
+            if self.corked:
+                uncork(connection)
         except:
-            with self.connections_lock:
-                if username in self.connections:
-                    del self.connections[username]
+            self.close_session(username, conn_data)
             return
 
+        # Live messages queued during the replay go out after HISTORY_END
+        threading.Thread(
+            target=self.writer_thread,
+            args=(username, conn_data),
+            daemon=True
+        ).start()
+
         self.push("server", recipient, f"[{username}] connected")
 
-        while True:
-            try:
-                msg = connection.recv(1024).decode('utf-8')
-            except:
-                msg = None
-
-            if not msg:
-                print(f"[{username}] disconnected")
-                try:
-                    connection.close()
-                except:
-                    pass
-                with self.connections_lock:
-                    if username in self.connections:
-                        del self.connections[username]
-                self.push("server", recipient, f"[{username}] disconnected")
-                break
+        # Messages sent right behind the handshake are already buffered
+        messages = buffered_messages(framing, lines)
+        try:
+            while messages is not None:
+                conn_data.last_active = time.monotonic()
+                for message_recipient, msg in messages:
+                    try:
+                        with self.tracer.span("message"):
+                            self.handle_message(username, conn_data, message_recipient, msg)
+                    except redis.RedisError as e:
+                        self.message_failed(username, conn_data, e)
+
+                messages = self.receive(connection, framing, lines)
+            print(f"[{username}] session {conn_data.session} closed")
+        finally:
+            # Also on an unexpected error, so the session is never left registered
+            current = self.close_session(username, conn_data)
 
-            self.push(username, recipient, msg)
+        # A session that was taken over leaves quietly, and so does
+        # everyone while the server drains
+        if current and not self.draining:
+            self.push("server", recipient, f"[{username}] disconnected")
 
     def execute(self, sock):
         try:
             sock.bind(('0.0.0.0', self.port))
-            sock.listen()
+            sock.listen(self.backlog)
             print("Listening for connections on: " + str(self.port))
 
-            while True:
-                client_connection, ip = sock.accept()
-                client_info = client_connection.recv(1024).decode('utf-8').strip()
-
-                client_username = client_info.split('--')[0]
-                client_recipient = client_info.split('--')[1]
+            if self.fanout is not None:
+                self.fanout.start()
+            if self.message_writer is not None:
+                self.message_writer.start()
+            if self.retention is not None:
+                self.retention.start()
+            if self.metrics_port:
+                start_metrics_server(self.metrics, self.metrics_port, self.instrumentation)
+            if self.idle_timeout:
+                threading.Thread(target=self.reaper_thread, daemon=True).start()
 
-                with self.connections_lock:
-                    self.connections[client_username] = (client_connection, client_recipient)
-
-                print(f"[{client_username}] connected")
+            while True:
+                client_connection, address = sock.accept()
+                if not self.admit(address[0]):
+                    client_connection.close()
+                    continue
 
                 threading.Thread(
-                    target=self.user_thread,
-                    args=(client_username,)
+                    target=self.client_thread,
+                    args=(client_connection,)
                 ).start()
 
+        except Draining:
+            sock.close()
+            self.drain()
         except OSError:
             print("Failed to bind to port: " + str(self.port))
 
-    def __str__(self):
-        return "Port: " + str(self.port)
+    def shutdown(self):
+        if self.retention is not None:
+            self.retention.stop()
+        if self.message_writer is not None:
+            self.message_writer.stop()
+        if self.fanout is not None:
+            self.fanout.stop()
 
-def main():
-    if(len(sys.argv) < 2):
-        print("Usage: python3 chat_server.py [port]")
-        return
+    def __str__(self):
+        return ("Port: " + str(self.port) + "\nEngine: " + self.engine
+                + "\nFanout: " + ("redis" if self.fanout is not None else "local")
+                + "\nPersistence: " + self.persistence)
 
-    server = ChatServer(sys.argv[1])
+def run_server(engine, port, options, reuse_port=False):
+    if engine == "asyncio":
+        from async_server import AsyncChatServer
+        server = AsyncChatServer(port, **options)
+    else:
+        server = ChatServer(port, **options)
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # A drained server closes its connections first, leaving them in
+    # TIME_WAIT; its replacement on the same host must still be able to bind
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Every worker binds its own socket; the kernel spreads new connections over them
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    # SIGTERM drains the connections, then exits normally so pending
+    # history writes are flushed; a second one stops at once
+    signal.signal(signal.SIGTERM, server.request_drain)
+    # SIGUSR1 and SIGUSR2 switch the span tracer and the sampling profiler
+    for signum, handler in server.instrumentation.signal_handlers():
+        signal.signal(signum, lambda signum, frame, handler=handler: handler())
 
     print("--- Server config ---\n" + str(server))
-    server.execute(sock)
+    try:
+        server.execute(sock)
+    except (KeyboardInterrupt, Draining):
+        pass
+    finally:
+        server.shutdown()
+
+
+def run_workers(workers, engine, port, options, startup_grace=5):
+    """Run the server in worker processes sharing the port, restarting any that crash.
+
+    Workers see each other's users only through Redis fan-out, exactly like
+    separate replicas. A worker that dies within startup_grace seconds of
+    starting (e.g. the port is taken) stops the whole group instead of
+    being restarted in a loop.
+    """
+    processes = {}
+    started = {}
+    stopping = False
+
+    def start(index):
+        worker_options = dict(options)
+        if worker_options["metrics_port"]:
+            worker_options["metrics_port"] += index
+        process = multiprocessing.Process(
+            target=run_server, args=(engine, port, worker_options, True), name=f"chat-worker-{index}"
+        )
+        process.start()
+        processes[index] = process
+        started[index] = time.monotonic()
+
+    def stop(signum=None, frame=None):
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+
+    def forward(signum, frame):
+        for process in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    # Every worker profiles itself and writes its own file
+    signal.signal(signal.SIGUSR1, forward)
+    signal.signal(signal.SIGUSR2, forward)
+    for index in range(workers):
+        start(index)
+    print(f"Started {workers} workers on port {port}")
+
+    try:
+        while not stopping:
+            multiprocessing.connection.wait([process.sentinel for process in processes.values()], timeout=1)
+            for index, process in list(processes.items()):
+                if process.is_alive() or stopping:
+                    continue
+                if time.monotonic() - started[index] < startup_grace:
+                    print(f"Worker {index} exited with {process.exitcode} during startup, stopping")
+                    stop()
+                    break
+                print(f"Worker {index} exited with {process.exitcode}, restarting")
+                start(index)
+    except KeyboardInterrupt:
+        # The terminal sent SIGINT to the workers too
+        stopping = True
+    for process in processes.values():
+        process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("port", help="Port to listen on")
+    parser.add_argument("--engine", choices=ENGINES, default=os.getenv("CHAT_ENGINE", "threads"),
+                        help="Serving engine: one thread per connection or a single asyncio event loop "
+                             "(default: $CHAT_ENGINE or threads)")
+    parser.add_argument("--fanout", action="store_true", default=os.getenv("CHAT_FANOUT", "0") == "1",
+                        help="Deliver messages across replicas over Redis pub/sub (default: $CHAT_FANOUT=1)")
+    parser.add_argument("--backlog", type=int, default=int(os.getenv("CHAT_BACKLOG", 1024)),
+                        help="Listen backlog of connections not yet accepted (default: $CHAT_BACKLOG or 1024)")
+    parser.add_argument("--handshake-timeout", type=float, default=float(os.getenv("CHAT_HANDSHAKE_TIMEOUT", 10)),
+                        help="Seconds a new connection has to complete its handshake "
+                             "(default: $CHAT_HANDSHAKE_TIMEOUT or 10)")
+    parser.add_argument("--connect-rate", type=float, default=float(os.getenv("CHAT_CONNECT_RATE", 0)),
+                        help="New connections per second allowed from one IP address, 0 disables the limit "
+                             "(default: $CHAT_CONNECT_RATE or 0)")
+    parser.add_argument("--connect-burst", type=int, default=int(os.getenv("CHAT_CONNECT_BURST", 20)),
+                        help="Connections one IP address may open at once before --connect-rate applies "
+                             "(default: $CHAT_CONNECT_BURST or 20)")
+    parser.add_argument("--message-rate", type=float, default=float(os.getenv("CHAT_MESSAGE_RATE", 0)),
+                        help="Messages per second one connection may send; past it the server stops reading "
+                             "from it until it is back under, 0 disables the limit "
+                             "(default: $CHAT_MESSAGE_RATE or 0)")
+    parser.add_argument("--message-burst", type=int, default=int(os.getenv("CHAT_MESSAGE_BURST", 20)),
+                        help="Messages a connection may send at once before --message-rate applies "
+                             "(default: $CHAT_MESSAGE_BURST or 20)")
+    parser.add_argument("--room-rate", type=float, default=float(os.getenv("CHAT_ROOM_RATE", 0)),
+                        help="Messages per second all senders on this server may send to one room, "
+                             "BROADCAST included, 0 disables the limit (default: $CHAT_ROOM_RATE or 0)")
+    parser.add_argument("--room-burst", type=int, default=int(os.getenv("CHAT_ROOM_BURST", 100)),
+                        help="Messages a room may receive at once before --room-rate applies "
+                             "(default: $CHAT_ROOM_BURST or 100)")
+    parser.add_argument("--idle-timeout", type=float, default=float(os.getenv("CHAT_IDLE_TIMEOUT", 0)),
+                        help="Close connections that send nothing, not even a /ping heartbeat, for this many "
+                             "seconds; 0 disables it (default: $CHAT_IDLE_TIMEOUT or 0)")
+    parser.add_argument("--keepalive", type=int, default=int(os.getenv("CHAT_KEEPALIVE", 60)),
+                        help="Seconds of silence before TCP keepalive probes check that a peer is still there, "
+                             "0 disables them (default: $CHAT_KEEPALIVE or 60)")
+    parser.add_argument("--drain-timeout", type=float, default=float(os.getenv("CHAT_DRAIN_TIMEOUT", 20)),
+                        help="On SIGTERM, stop accepting and ask clients to reconnect at random times over the "
+                             "first half of this many seconds, then close whoever is left "
+                             "(default: $CHAT_DRAIN_TIMEOUT or 20)")
+    parser.add_argument("--profile-dir", default=os.getenv("CHAT_PROFILE_DIR"),
+                        help="Where SIGUSR1 (spans) and SIGUSR2 (sampling profiler) write their collapsed-stack "
+                             "files (default: $CHAT_PROFILE_DIR or the temp directory)")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("CHAT_WORKERS", 1)),
+                        help="Server processes sharing the port via SO_REUSEPORT; more than one implies "
+                             "--fanout, and worker i serves metrics on --metrics-port + i "
+                             "(default: $CHAT_WORKERS or 1)")
+    parser.add_argument("--outbound-queue", type=int, default=int(os.getenv("CHAT_OUTBOUND_QUEUE", 1024)),
+                        help="Max frames pending per connection (default: $CHAT_OUTBOUND_QUEUE or 1024)")
+    parser.add_argument("--flush-window-ms", type=float, default=float(os.getenv("CHAT_FLUSH_WINDOW_MS", 0)),
+                        help="Hold a connection's outgoing frames up to this long to send them in one write, "
+                             "0 sends as soon as its writer is free (default: $CHAT_FLUSH_WINDOW_MS or 0)")
+    parser.add_argument("--flush-bytes", type=int, default=int(os.getenv("CHAT_FLUSH_BYTES", 65536)),
+                        help="Send a held batch early once this many bytes are pending "
+                             "(default: $CHAT_FLUSH_BYTES or 65536)")
+    parser.add_argument("--tcp-mode", choices=TCP_MODES, default=os.getenv("CHAT_TCP_MODE", "nodelay"),
+                        help="Send every write at once (nodelay), let the kernel delay small writes while "
+                             "earlier data is unacknowledged (nagle), or keep the socket corked and flush it "
+                             "after each batch so batches leave in full packets (cork, Linux only) "
+                             "(default: $CHAT_TCP_MODE or nodelay)")
+    parser.add_argument("--history-cache-mb", type=int, default=int(os.getenv("CHAT_HISTORY_CACHE_MB", 8)),
+                        help="Memory cap for the in-process history cache, 0 disables it "
+                             "(default: $CHAT_HISTORY_CACHE_MB or 8)")
+    parser.add_argument("--persistence", choices=PERSISTENCE_MODES,
+                        default=os.getenv("CHAT_PERSISTENCE", "async"),
+                        help="History writes: one RPUSH per message (direct), batched pipelines the sender "
+                             "waits for (sync) or write-behind (async) (default: $CHAT_PERSISTENCE or async)")
+    parser.add_argument("--history-format", choices=HISTORY_FORMATS,
+                        default=os.getenv("CHAT_HISTORY_FORMAT", "compact"),
+                        help="How new history entries are stored: compact records holding the pre-rendered "
+                             "line, or the older JSON objects; both are always readable "
+                             "(default: $CHAT_HISTORY_FORMAT or compact)")
+    parser.add_argument("--persist-batch", type=int, default=int(os.getenv("CHAT_PERSIST_BATCH", 128)),
+                        help="Max history writes per pipeline (default: $CHAT_PERSIST_BATCH or 128)")
+    parser.add_argument("--persist-interval-ms", type=float, default=float(os.getenv("CHAT_PERSIST_INTERVAL_MS", 5)),
+                        help="Max time an async history write waits for its batch to fill "
+                             "(default: $CHAT_PERSIST_INTERVAL_MS or 5)")
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv("CHAT_METRICS_PORT", 0)),
+                        help="Serve Prometheus metrics on this port at /metrics, 0 disables it "
+                             "(default: $CHAT_METRICS_PORT or 0)")
+    parser.add_argument("--retention-max-entries", type=int,
+                        default=int(os.getenv("CHAT_RETENTION_MAX_ENTRIES", 0)),
+                        help="Trim each conversation's history to this many entries, 0 keeps everything "
+                             "(default: $CHAT_RETENTION_MAX_ENTRIES or 0)")
+    parser.add_argument("--retention-max-age-hours", type=float,
+                        default=float(os.getenv("CHAT_RETENTION_MAX_AGE_HOURS", 0)),
+                        help="Trim history entries older than this, 0 keeps everything "
+                             "(default: $CHAT_RETENTION_MAX_AGE_HOURS or 0)")
+    parser.add_argument("--archive-dir", default=os.getenv("CHAT_ARCHIVE_DIR") or None,
+                        help="Write trimmed history to gzip segment files under this directory "
+                             "before removing it (default: $CHAT_ARCHIVE_DIR, off)")
+    parser.add_argument("--overflow-policy", choices=OVERFLOW_POLICIES,
+                        default=os.getenv("CHAT_OVERFLOW_POLICY", "disconnect"),
+                        help="What to do when a connection's outbound queue is full "
+                             "(default: $CHAT_OVERFLOW_POLICY or disconnect)")
+    args = parser.parse_args()
+
+    options = dict(
+        fanout=args.fanout,
+        outbound_queue=args.outbound_queue,
+        overflow_policy=args.overflow_policy,
+        history_cache_mb=args.history_cache_mb,
+        persistence=args.persistence,
+        persist_batch=args.persist_batch,
+        persist_interval_ms=args.persist_interval_ms,
+        metrics_port=args.metrics_port,
+        retention_max_entries=args.retention_max_entries,
+        retention_max_age_hours=args.retention_max_age_hours,
+        archive_dir=args.archive_dir,
+        backlog=args.backlog,
+        handshake_timeout=args.handshake_timeout,
+        connect_rate=args.connect_rate,
+        connect_burst=args.connect_burst,
+        idle_timeout=args.idle_timeout,
+        keepalive=args.keepalive,
+        history_format=args.history_format,
+        flush_window_ms=args.flush_window_ms,
+        flush_bytes=args.flush_bytes,
+        tcp_mode=args.tcp_mode,
+        message_rate=args.message_rate,
+        message_burst=args.message_burst,
+        room_rate=args.room_rate,
+        room_burst=args.room_burst,
+        drain_timeout=args.drain_timeout,
+        profile_dir=args.profile_dir,
+    )
+    if args.workers > 1:
+        if not options["fanout"]:
+            print("Enabling fan-out: workers reach each other's users through Redis")
+            options["fanout"] = True
+        run_workers(args.workers, args.engine, args.port, options)
+    else:
+        run_server(args.engine, args.port, options)
 
 if __name__ == "__main__":
     main()
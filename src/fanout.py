@@ -0,0 +1,182 @@
+import json
+import queue
+import threading
+import time
+import uuid
+
+import redis
+
+from profiling import Tracer
+from protocol import is_room
+
+BROADCAST_CHANNEL = "chat:broadcast"
+USER_CHANNEL_PREFIX = "chat:user:"
+ROOM_CHANNEL_PREFIX = "chat:room:"
+
+
+def user_channel(username):
+    return USER_CHANNEL_PREFIX + username
+
+
+def room_channel(room):
+    return ROOM_CHANNEL_PREFIX + room
+
+
+def recipient_channel(recipient):
+    if recipient == "BROADCAST":
+        return BROADCAST_CHANNEL
+    if is_room(recipient):
+        return room_channel(recipient)
+    return user_channel(recipient)
+
+
+class RedisFanout:
+    """Cross-replica delivery over Redis pub/sub.
+
+    Every replica subscribes to the broadcast channel plus one channel per
+    locally connected user and per room with a local member. Outgoing messages are queued and a publisher
+    thread flushes them in batches: all messages for the same channel inside
+    one flush window share a single PUBLISH, and all PUBLISHes of a flush go
+    out in one pipeline round trip.
+
+    ``deliver(sender, recipient, message, ts)`` is called from the subscriber
+    thread for every message published by another replica; ``ts`` is the
+    message ID, None for server notices and for replicas that predate it. ``client`` is any
+    redis-py compatible client (a real ``redis.Redis`` or a fakeredis one).
+    ``tracer`` times the publish and receive stages (see profiling.py).
+    """
+
+    def __init__(self, client, deliver, batch_size=256, flush_interval=0.002, replica_id=None, tracer=None):
+        self.client = client
+        self.deliver = deliver
+        self.tracer = tracer or Tracer()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.replica_id = replica_id or uuid.uuid4().hex
+        self.outbox = queue.Queue()
+        self.subscription_changes = queue.Queue()
+        self.local_channels = set()
+        self.local_channels_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.stats = {"published": 0, "publish_batches": 0, "received": 0, "errors": 0}
+
+    def start(self):
+        threading.Thread(target=self.publisher_thread, daemon=True).start()
+        threading.Thread(target=self.subscriber_thread, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def subscribe(self, channel):
+        with self.local_channels_lock:
+            self.local_channels.add(channel)
+        self.subscription_changes.put(("subscribe", channel))
+
+    def unsubscribe(self, channel):
+        with self.local_channels_lock:
+            self.local_channels.discard(channel)
+        self.subscription_changes.put(("unsubscribe", channel))
+
+    def subscribe_user(self, username):
+        self.subscribe(user_channel(username))
+
+    def unsubscribe_user(self, username):
+        self.unsubscribe(user_channel(username))
+
+    def subscribe_room(self, room):
+        self.subscribe(room_channel(room))
+
+    def unsubscribe_room(self, room):
+        self.unsubscribe(room_channel(room))
+
+    def publish(self, sender, recipient, message, ts=None):
+        self.outbox.put((sender, recipient, message, ts))
+
+    def next_batch(self):
+        try:
+            batch = [self.outbox.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.outbox.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, batch):
+        channels = {}
+        for sender, recipient, message, ts in batch:
+            channels.setdefault(recipient_channel(recipient), []).append([sender, recipient, message, ts])
+
+        pipe = self.client.pipeline(transaction=False)
+        for channel, messages in channels.items():
+            pipe.publish(channel, json.dumps({"origin": self.replica_id, "messages": messages}))
+        pipe.execute()
+
+        self.stats["published"] += len(batch)
+        self.stats["publish_batches"] += 1
+
+    def publisher_thread(self):
+        while not self.stop_event.is_set():
+            batch = self.next_batch()
+            if not batch:
+                continue
+            try:
+                with self.tracer.span("fanout_publish"):
+                    self.flush(batch)
+            except redis.RedisError as e:
+                self.stats["errors"] += 1
+                print(f"Fanout publish failed, dropped {len(batch)} messages: {e}")
+
+    def handle_message(self, message):
+        try:
+            payload = json.loads(message["data"])
+        except (TypeError, ValueError):
+            return
+        if payload.get("origin") == self.replica_id:
+            return
+
+        with self.tracer.span("fanout_receive"):
+            for sender, recipient, message, *rest in payload.get("messages", []):
+                self.stats["received"] += 1
+                self.deliver(sender, recipient, message, rest[0] if rest else None)
+
+    def apply_subscription_changes(self, pubsub):
+        while True:
+            try:
+                action, channel = self.subscription_changes.get_nowait()
+            except queue.Empty:
+                return
+            if action == "subscribe":
+                pubsub.subscribe(channel)
+            else:
+                pubsub.unsubscribe(channel)
+
+    def subscriber_thread(self):
+        while not self.stop_event.is_set():
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                # (Re)subscribe from scratch so a reconnect picks up every local channel
+                while not self.subscription_changes.empty():
+                    self.subscription_changes.get_nowait()
+                with self.local_channels_lock:
+                    channels = list(self.local_channels)
+                pubsub.subscribe(BROADCAST_CHANNEL, *channels)
+
+                while not self.stop_event.is_set():
+                    self.apply_subscription_changes(pubsub)
+                    message = pubsub.get_message(timeout=0.05)
+                    if message is not None and message["type"] == "message":
+                        self.handle_message(message)
+            except redis.RedisError as e:
+                self.stats["errors"] += 1
+                print(f"Fanout subscriber error, resubscribing: {e}")
+                time.sleep(1)
+            finally:
+                pubsub.close()
@@ -0,0 +1,113 @@
+import sys
+import threading
+from collections import OrderedDict, deque
+
+# Marks a load that a concurrent append made stale, as opposed to no load
+STALE = object()
+# A deque's own size, and what each entry adds to it (one pointer)
+CHANNEL_OVERHEAD = sys.getsizeof(deque())
+SLOT_SIZE = 8
+
+
+def entry_size(entry):
+    """Memory held by one (ts, line) entry: the tuple, the float and the str with their object headers."""
+    ts, line = entry
+    size = SLOT_SIZE + sys.getsizeof(entry) + sys.getsizeof(line)
+    if ts is not None:
+        size += sys.getsizeof(ts)
+    return size
+
+
+class HistoryCache:
+    """In-process cache of the most recent history entries per channel.
+
+    Entries are (ts, rendered line) pairs. Channels are evicted least
+    recently used first once they take more than ``max_bytes`` in total,
+    counted as the memory the entries really hold (``entry_size``), which
+    is several times the length of a short line;
+    each channel keeps at most ``max_lines``. A channel is either fully cached (its last ``max_lines``
+    entries, identical to what Redis would return) or absent, so callers
+    load a cold channel from Redis with ``start_load``/``fill`` and
+    ``append`` only ever extends channels that are already complete.
+
+    A write that lands while a channel is being loaded may or may not be in
+    the loaded snapshot, so ``append`` marks such a load stale and ``fill``
+    then discards it; the next reader simply loads again.
+    """
+
+    def __init__(self, max_lines, max_bytes):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.channels = OrderedDict()
+        self.channel_bytes = {}
+        self.total_bytes = 0
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        with self.lock:
+            lines = self.channels.get(key)
+            if lines is None:
+                self.stats["misses"] += 1
+                return None
+            self.channels.move_to_end(key)
+            self.stats["hits"] += 1
+            return list(lines)
+
+    def start_load(self, key):
+        token = object()
+        with self.lock:
+            self.loading[key] = token
+        return token
+
+    def fill(self, key, lines, token):
+        with self.lock:
+            current = self.loading.get(key)
+            # A newer load of the same channel may have finished first and
+            # removed the entry already
+            if current is token or current is STALE:
+                del self.loading[key]
+            if current is not token:
+                return
+
+            self.discard(key)
+            cached = deque(lines[-self.max_lines:], maxlen=self.max_lines)
+            self.channels[key] = cached
+            self.channel_bytes[key] = CHANNEL_OVERHEAD + sum(entry_size(entry) for entry in cached)
+            self.total_bytes += self.channel_bytes[key]
+            self.evict()
+
+    def append(self, key, entry):
+        with self.lock:
+            if key in self.loading:
+                self.loading[key] = STALE
+
+            lines = self.channels.get(key)
+            if lines is None:
+                return
+
+            if len(lines) == self.max_lines:
+                removed = entry_size(lines[0])
+                self.channel_bytes[key] -= removed
+                self.total_bytes -= removed
+            lines.append(entry)
+            added = entry_size(entry)
+            self.channel_bytes[key] += added
+            self.total_bytes += added
+            self.channels.move_to_end(key)
+            self.evict()
+
+    def invalidate(self, key):
+        with self.lock:
+            self.discard(key)
+
+    def discard(self, key):
+        if self.channels.pop(key, None) is not None:
+            self.total_bytes -= self.channel_bytes.pop(key)
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and self.channels:
+            key, _ = self.channels.popitem(last=False)
+            self.total_bytes -= self.channel_bytes.pop(key)
+            self.stats["evictions"] += 1
@@ -0,0 +1,112 @@
+"""
+Stored history entry formats.
+
+Entries were JSON objects, which repeat every field name and have to be
+parsed and re-rendered on every replay. Compact records store the line
+exactly as replay sends it, behind a versioned header:
+
+    RECORD_TAG VERSION " " ts " " len(sender) " " len(recipient) " " "[sender]:[recipient] message"
+
+so replay only splits off the header; the sender, recipient and message are
+sliced back out of the line by length when something needs them (retention
+archives). Both formats stay readable: RECORD_TAG never starts a JSON
+entry. Records are text rather than packed binary because every Redis
+client in the service decodes responses to str.
+"""
+
+import json
+
+RECORD_TAG = "\x1e"
+VERSION = "1"
+HISTORY_FORMATS = ("compact", "json")
+
+
+def history_line(sender, recipient, message):
+    return f"[{sender}]:[{recipient}] {message}\n"
+
+
+def encode_json(sender, recipient, message, ts):
+    # "ts" is the message's ID for stamped clients and lets retention
+    # expire entries by age
+    return json.dumps({
+        "sender": sender,
+        "recipient": recipient,
+        "message": message,
+        "ts": ts
+    })
+
+
+def encode_compact(sender, recipient, message, ts):
+    return f"{RECORD_TAG}{VERSION} {ts:.6f} {len(sender)} {len(recipient)} [{sender}]:[{recipient}] {message}"
+
+
+ENCODERS = {"compact": encode_compact, "json": encode_json}
+
+
+def decode_line(raw):
+    """Return (ts, rendered line) for a stored entry, or None if it cannot be read.
+
+    ts is None for JSON entries written before timestamps existed.
+    """
+    if raw.startswith(RECORD_TAG):
+        header = raw.split(" ", 4)
+        if header[0] != RECORD_TAG + VERSION or len(header) < 5:
+            return None
+        try:
+            return float(header[1]), header[4] + "\n"
+        except ValueError:
+            return None
+
+    try:
+        entry = json.loads(raw)
+        return entry.get("ts"), history_line(entry["sender"], entry["recipient"], entry["message"])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def decode_fields(raw):
+    """Return the entry as a dict with sender, recipient, message and ts, or None if it cannot be read."""
+    if not raw.startswith(RECORD_TAG):
+        try:
+            entry = json.loads(raw)
+        except ValueError:
+            return None
+        return entry if isinstance(entry, dict) else None
+
+    try:
+        tag, ts, sender_len, recipient_len, line = raw.split(" ", 4)
+        sender_len, recipient_len = int(sender_len), int(recipient_len)
+        ts = float(ts)
+    except ValueError:
+        return None
+    if tag != RECORD_TAG + VERSION:
+        return None
+    # line is "[" sender "]:[" recipient "] " message
+    recipient_start = sender_len + 4
+    return {
+        "sender": line[1:1 + sender_len],
+        "recipient": line[recipient_start:recipient_start + recipient_len],
+        "message": line[recipient_start + recipient_len + 2:],
+        "ts": ts,
+    }
+
+
+def entry_time(raw):
+    """Return the entry's timestamp, or None for entries written before timestamps existed."""
+    if raw.startswith(RECORD_TAG):
+        try:
+            return float(raw.split(" ", 2)[1])
+        except (ValueError, IndexError):
+            return None
+    try:
+        return json.loads(raw).get("ts")
+    except (ValueError, AttributeError):
+        return None
+
+
+def as_json(raw):
+    """Return the entry as a JSON object string, converting compact records; unreadable entries are kept as they are."""
+    if not raw.startswith(RECORD_TAG):
+        return raw
+    fields = decode_fields(raw)
+    return json.dumps(fields) if fields is not None else raw
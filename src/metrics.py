@@ -0,0 +1,275 @@
+"""
+Minimal Prometheus text-format metrics for the chat server.
+
+Counters and histograms are updated on the hot paths with one uncontended
+lock acquisition each; anything that already exists as server state
+(connection count, queue depths, helper-thread stats) is read only when the
+endpoint is scraped.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+FANOUT_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 500, 1000)
+BATCH_BYTES_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, n=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values or [((), 0)]:
+            lines.append(f"{self.name}{format_labels(dict(key))} {value}")
+        return lines
+
+
+class CallbackMetric:
+    """Gauge or counter whose samples are computed at scrape time.
+
+    ``collect`` returns a number or a list of (labels dict, value) pairs.
+    """
+
+    def __init__(self, name, help, collect, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.kind = kind
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        samples = self.collect()
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class ChatMetrics:
+    def __init__(self, server):
+        self.messages_in = Counter("chat_messages_in_total", "Chat messages received from clients")
+        self.messages_out = Counter("chat_messages_out_total", "Frames queued for delivery to clients")
+        self.redis_errors = Counter("chat_redis_errors_total", "Redis command failures by operation")
+        self.fanout_size = Histogram(
+            "chat_broadcast_fanout_size", "Local recipients per broadcast", FANOUT_BUCKETS
+        )
+        self.save_latency = Histogram(
+            "chat_save_message_seconds", "Time spent in save_message", LATENCY_BUCKETS
+        )
+        self.history_latency = Histogram(
+            "chat_send_history_seconds", "Time spent replaying history to a new connection", LATENCY_BUCKETS
+        )
+        self.send_batch_frames = Histogram(
+            "chat_send_batch_frames", "Frames sent to a connection in one write", BATCH_BUCKETS
+        )
+        self.send_batch_bytes = Histogram(
+            "chat_send_batch_bytes", "Bytes sent to a connection in one write", BATCH_BYTES_BUCKETS
+        )
+        self.connections = Counter(
+            "chat_connections_total", "Accepted connections by outcome: ok, rate_limited, timeout or invalid"
+        )
+        self.handshake_latency = Histogram(
+            "chat_handshake_seconds", "Time from accept to a completed handshake", LATENCY_BUCKETS
+        )
+        self.rate_limited = Counter(
+            "chat_rate_limited_total", "Messages held back by --message-rate (connection) or --room-rate (room)"
+        )
+        self.rate_limited_seconds = Counter(
+            "chat_rate_limited_seconds_total", "Time readers spent paused by the message rate limits"
+        )
+        self.messages_failed = Counter(
+            "chat_messages_failed_total", "Client messages or commands dropped because a Redis call failed"
+        )
+        self.sessions_reaped = Counter(
+            "chat_sessions_reaped_total", "Sessions closed by the server: taken_over by a reconnect or idle"
+        )
+        self.metrics = [
+            CallbackMetric("chat_active_connections", "Connected clients", lambda: len(server.connections)),
+            CallbackMetric(
+                "chat_open_sessions", "Connections whose handler is still running", lambda: server.open_sessions
+            ),
+            CallbackMetric(
+                "chat_detached_sessions",
+                "Open sessions no longer registered to their user; one that stays above zero is leaking",
+                lambda: max(0, server.open_sessions - len(server.connections)),
+            ),
+            self.sessions_reaped,
+            self.rate_limited,
+            self.rate_limited_seconds,
+            CallbackMetric("chat_rooms", "Rooms with at least one local member", lambda: len(server.rooms)),
+            self.connections,
+            self.handshake_latency,
+            self.messages_in,
+            self.messages_failed,
+            self.messages_out,
+            self.fanout_size,
+            self.send_batch_frames,
+            self.send_batch_bytes,
+            self.save_latency,
+            self.history_latency,
+            self.redis_errors,
+            CallbackMetric(
+                "chat_background_redis_errors_total",
+                "Redis failures in the write-behind and fan-out threads",
+                lambda: self.background_errors(server),
+                kind="counter",
+            ),
+            CallbackMetric(
+                "chat_history_trimmed_total",
+                "History entries removed by retention",
+                lambda: server.retention.stats["trimmed"] if server.retention is not None else 0,
+                kind="counter",
+            ),
+            CallbackMetric(
+                "chat_send_queue_depth",
+                "Frames waiting in a connection's outbound queue (non-empty queues only)",
+                lambda: self.queue_depths(server),
+            ),
+            CallbackMetric(
+                "chat_send_queue_depth_max",
+                "Deepest outbound queue",
+                lambda: max(server.queue_stats()["queue_depth"].values(), default=0),
+            ),
+            CallbackMetric(
+                "chat_send_queue_dropped_total",
+                "Frames dropped by the outbound overflow policy",
+                lambda: server.outbound_stats.snapshot()["dropped"],
+                kind="counter",
+            ),
+        ]
+
+    def background_errors(self, server):
+        samples = []
+        if server.message_writer is not None:
+            samples.append(({"stage": "persistence"}, server.message_writer.stats["failed"]))
+        if server.fanout is not None:
+            samples.append(({"stage": "fanout"}, server.fanout.stats["errors"]))
+        if server.retention is not None:
+            samples.append(({"stage": "retention"}, server.retention.stats["errors"]))
+        return samples
+
+    def queue_depths(self, server):
+        return [
+            ({"user": name}, depth)
+            for name, depth in server.queue_stats()["queue_depth"].items()
+            if depth > 0
+        ]
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+DEBUG_PATHS = {"/debug/spans": "spans", "/debug/profile": "profile"}
+
+
+def start_metrics_server(metrics, port, instrumentation=None):
+    """Serve /metrics, and with instrumentation /debug/spans and /debug/profile (see profiling.py)."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == "/metrics":
+                self.reply(metrics.render(), "text/plain; version=0.0.4")
+            elif url.path in DEBUG_PATHS and instrumentation is not None:
+                self.capture(DEBUG_PATHS[url.path], parse_qs(url.query))
+            else:
+                self.send_error(404)
+
+        def capture(self, kind, query):
+            try:
+                seconds = float(query.get("seconds", ["10"])[0])
+            except ValueError:
+                self.send_error(400, "seconds must be a number")
+                return
+            stacks = instrumentation.capture(kind, seconds)
+            if stacks is None:
+                self.send_error(409, f"{kind} is already running")
+                return
+            self.reply(stacks, "text/plain")
+
+        def reply(self, text, content_type):
+            body = text.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print("Serving metrics on: " + str(port))
+    return httpd
@@ -0,0 +1,107 @@
+"""
+Rebuild the per-conversation history keys from the legacy global
+chat_history list.
+
+Usage:
+    python3 src/migrate_history.py [--batch N] [--dry-run] [--delete-legacy] [--force]
+
+The legacy list is read in pages and every entry is appended to a temporary
+"<key>:migrating" list for its conversation. Each conversation key is then
+replaced in a WATCH/MULTI transaction by the migrated entries followed by
+whatever the server already wrote to it, so the tool is safe to run while
+servers are live. A marker key records a completed migration; running again
+would append the legacy entries a second time, so that needs --force.
+"""
+
+import sys
+import json
+import argparse
+
+import redis
+
+from chat_server import redis_options, history_key, LEGACY_HISTORY_KEY
+
+MIGRATED_MARKER_KEY = "chat_history:migrated"
+
+
+def copy_legacy(client, batch, dry_run):
+    counts = {}
+    skipped = 0
+    start = 0
+    while True:
+        page = client.lrange(LEGACY_HISTORY_KEY, start, start + batch - 1)
+        if not page:
+            break
+        start += len(page)
+
+        pipe = client.pipeline(transaction=False)
+        for raw in page:
+            try:
+                entry = json.loads(raw)
+                key = history_key(entry["sender"], entry["recipient"])
+            except (json.JSONDecodeError, KeyError, TypeError):
+                skipped += 1
+                continue
+
+            if counts.get(key) is None:
+                counts[key] = 0
+                pipe.delete(key + ":migrating")
+            counts[key] += 1
+            pipe.rpush(key + ":migrating", raw)
+        if not dry_run:
+            pipe.execute()
+
+    return counts, skipped
+
+
+def swap_in(client, key):
+    temp_key = key + ":migrating"
+
+    def merge(pipe):
+        live = pipe.lrange(key, 0, -1)
+        pipe.multi()
+        if live:
+            pipe.rpush(temp_key, *live)
+        pipe.rename(temp_key, key)
+
+    client.transaction(merge, key)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rebuild per-conversation history keys from chat_history',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--batch', type=int, default=1000, help='Legacy entries read per round trip (default: 1000)')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be migrated')
+    parser.add_argument('--delete-legacy', action='store_true', help='Delete chat_history after migrating')
+    parser.add_argument('--force', action='store_true', help='Migrate again even if a previous run completed')
+    args = parser.parse_args()
+
+    client = redis.Redis(**redis_options())
+
+    try:
+        if client.exists(MIGRATED_MARKER_KEY) and not args.force:
+            print("History was already migrated; pass --force to migrate again")
+            return
+
+        counts, skipped = copy_legacy(client, args.batch, args.dry_run)
+        if not args.dry_run:
+            for key in counts:
+                swap_in(client, key)
+            if args.delete_legacy:
+                client.delete(LEGACY_HISTORY_KEY)
+            client.set(MIGRATED_MARKER_KEY, sum(counts.values()))
+    except redis.RedisError as e:
+        print(f"Migration failed: {e}")
+        sys.exit(1)
+
+    for key, count in sorted(counts.items()):
+        print(f"{key}: {count} entries")
+    print(f"Migrated {sum(counts.values())} entries into {len(counts)} keys, skipped {skipped}"
+          + (" (dry run)" if args.dry_run else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import time
+import asyncio
+import threading
+from collections import deque
+
+OVERFLOW_POLICIES = ("disconnect", "drop_oldest", "coalesce")
+
+
+class OutboundStats:
+    """Server-wide counters shared by every outbound queue."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = 0
+
+    def count(self, name, n=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "disconnected": self.disconnected,
+            }
+
+
+class FrameBuffer:
+    """Bounded list of encoded frames waiting for one connection's writer.
+
+    When ``maxsize`` frames are already pending the overflow policy decides
+    what happens to a new frame:
+
+    - ``disconnect``: refuse it and mark the buffer closed so the caller can
+      drop the slow consumer (it gets the backlog again from history on
+      reconnect).
+    - ``drop_oldest``: discard the oldest pending frame.
+    - ``coalesce``: merge the pending frames into one so the writer sends them
+      in a single write; past ``max_bytes`` this falls back to disconnect.
+
+    With a ``window`` (seconds) the writer holds back a batch until its
+    oldest frame has waited that long or ``flush_bytes`` are pending, so a
+    busy connection gets fewer, larger writes at a bounded extra latency.
+    ``batch`` is the number of frames in the last batch handed out.
+
+    Not thread-safe on its own; the engine-specific subclasses add locking
+    and wake-ups.
+    """
+
+    def __init__(self, maxsize, policy, stats, max_bytes=1 << 20, window=0, flush_bytes=1 << 16):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.stats = stats
+        self.max_bytes = max_bytes
+        self.window = window
+        self.flush_bytes = flush_bytes
+        self.frames = deque()
+        self.pending_bytes = 0
+        self.pending_frames = 0
+        self.first_at = 0
+        self.batch = 0
+        self.dropped = 0
+        self.closed = False
+
+    @property
+    def depth(self):
+        return len(self.frames)
+
+    def offer(self, data):
+        """True if the frame was queued, False if it overflowed the buffer (closing it), None if the buffer was already closed."""
+        if self.closed:
+            return None
+
+        if len(self.frames) >= self.maxsize:
+            if self.policy == "drop_oldest":
+                self.pending_bytes -= len(self.frames.popleft())
+                self.pending_frames -= 1
+                self.dropped += 1
+                self.stats.count("dropped")
+            elif self.policy == "coalesce" and self.pending_bytes + len(data) <= self.max_bytes:
+                merged = b"".join(self.frames)
+                self.stats.count("coalesced", len(self.frames) - 1)
+                self.frames = deque([merged])
+            else:
+                self.dropped += 1
+                self.closed = True
+                self.stats.count("dropped")
+                self.stats.count("disconnected")
+                return False
+
+        if not self.frames:
+            self.first_at = time.monotonic()
+        self.frames.append(data)
+        self.pending_bytes += len(data)
+        self.pending_frames += 1
+        return True
+
+    def wake_writer(self):
+        # Without a window every frame wakes the writer; with one only the
+        # frame that starts a batch or fills it does
+        return not self.window or self.pending_frames == 1 or self.pending_bytes >= self.flush_bytes
+
+    def hold_for(self):
+        """Seconds the pending batch may still wait for more frames, 0 if it should go now."""
+        if not self.window or self.closed or self.pending_bytes >= self.flush_bytes:
+            return 0
+        return max(0, self.first_at + self.window - time.monotonic())
+
+    def take_all(self):
+        if len(self.frames) == 1:
+            data = self.frames.popleft()
+        else:
+            data = b"".join(self.frames)
+            self.frames.clear()
+        self.batch = self.pending_frames
+        self.pending_bytes = 0
+        self.pending_frames = 0
+        return data
+
+
+class OutboundQueue(FrameBuffer):
+    """FrameBuffer drained by a dedicated writer thread."""
+
+    def __init__(self, maxsize, policy, stats, max_bytes=1 << 20, window=0, flush_bytes=1 << 16):
+        super().__init__(maxsize, policy, stats, max_bytes, window, flush_bytes)
+        self.cond = threading.Condition()
+
+    def put(self, data):
+        with self.cond:
+            accepted = self.offer(data)
+            if not accepted or self.wake_writer():
+                self.cond.notify()
+        return accepted
+
+    def get(self):
+        """Block until frames are pending and return them as one buffer, or None once closed."""
+        with self.cond:
+            while not self.frames and not self.closed:
+                self.cond.wait()
+            hold = self.hold_for()
+            while hold > 0:
+                self.cond.wait(hold)
+                hold = self.hold_for()
+            if self.closed:
+                return None
+            return self.take_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+
+class AsyncOutboundQueue(FrameBuffer):
+    """FrameBuffer drained by a writer task on the event loop."""
+
+    def __init__(self, maxsize, policy, stats, max_bytes=1 << 20, window=0, flush_bytes=1 << 16):
+        super().__init__(maxsize, policy, stats, max_bytes, window, flush_bytes)
+        self.ready = asyncio.Event()
+
+    def put(self, data):
+        accepted = self.offer(data)
+        if not accepted or self.wake_writer():
+            self.ready.set()
+        return accepted
+
+    async def get(self):
+        while not self.frames and not self.closed:
+            self.ready.clear()
+            await self.ready.wait()
+        hold = self.hold_for()
+        while hold > 0:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), hold)
+            except asyncio.TimeoutError:
+                pass
+            hold = self.hold_for()
+        if self.closed:
+            return None
+        return self.take_all()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
@@ -0,0 +1,129 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import redis
+
+from profiling import Tracer
+
+PERSISTENCE_MODES = ("direct", "sync", "async")
+
+
+class WriterStopped(redis.RedisError):
+    """Raised by ``save`` once the writer is stopping; a RedisError, so senders handle it like a failed write."""
+
+
+class MessageWriter:
+    """Write-behind stage that persists history entries in pipelined batches.
+
+    ``save`` appends an RPUSH to the pending batch and returns a
+    ``concurrent.futures.Future`` shared by every entry of that batch; it
+    resolves once the batch's pipeline has executed. A flusher thread sends
+    the pending batch when it reaches ``batch_size`` entries or
+    ``flush_interval`` seconds after its first entry, whichever comes first.
+
+    Callers choose the durability: wait on the future (sync ack, still
+    grouped with concurrent senders) or ignore it (async flush). ``stop``
+    flushes whatever is pending before returning. ``unwritten`` returns the
+    entries of a key that are queued or being written, which readers of
+    that key have to add to what Redis returns. ``tracer`` times each
+    flush (see profiling.py).
+    """
+
+    def __init__(self, client, batch_size=128, flush_interval=0.005, retries=3, tracer=None):
+        self.client = client
+        self.tracer = tracer or Tracer()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.pending = []
+        self.pending_ack = Future()
+        # The batch the flusher is writing; guarded by cond
+        self.flushing = []
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.thread = None
+        self.stats = {"saved": 0, "batches": 0, "failed": 0}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.flusher_thread, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def save(self, key, raw):
+        with self.cond:
+            if self.stopping:
+                raise WriterStopped("Message writer is stopped")
+            self.pending.append((key, raw))
+            ack = self.pending_ack
+            if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+                self.cond.notify()
+        return ack
+
+    def next_batch(self):
+        with self.cond:
+            while not self.pending and not self.stopping:
+                self.cond.wait()
+
+            deadline = time.monotonic() + self.flush_interval
+            while len(self.pending) < self.batch_size and not self.stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            batch, ack = self.pending, self.pending_ack
+            self.pending, self.pending_ack = [], Future()
+            self.flushing = batch
+            return batch, ack
+
+    def unwritten(self, key):
+        """Return the raw entries for key not yet known to be in Redis, oldest first."""
+        with self.cond:
+            return [raw for entry_key, raw in self.flushing + self.pending if entry_key == key]
+
+    def flush(self, batch):
+        # MULTI/EXEC: a batch that failed part way through has written
+        # nothing, so retrying it cannot push an entry twice. Only
+        # connection errors are retried; an error reply would fail again
+        for attempt in range(self.retries):
+            pipe = self.client.pipeline(transaction=True)
+            for key, raw in batch:
+                pipe.rpush(key, raw)
+            try:
+                pipe.execute()
+                return
+            except (redis.ConnectionError, redis.TimeoutError):
+                if attempt == self.retries - 1:
+                    raise
+                time.sleep(0.1 * 2 ** attempt)
+
+    def flusher_thread(self):
+        while True:
+            batch, ack = self.next_batch()
+            if batch:
+                error = None
+                try:
+                    with self.tracer.span("persist"):
+                        self.flush(batch)
+                except redis.RedisError as e:
+                    error = e
+                # Written or dropped, the batch is no longer unwritten
+                with self.cond:
+                    self.flushing = []
+                if error is not None:
+                    self.stats["failed"] += len(batch)
+                    print(f"History write failed, dropped {len(batch)} messages: {error}")
+                    ack.set_exception(error)
+                else:
+                    self.stats["saved"] += len(batch)
+                    self.stats["batches"] += 1
+                    ack.set_result(len(batch))
+            elif self.stopping:
+                return
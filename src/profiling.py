@@ -0,0 +1,219 @@
+"""
+On-demand instrumentation for a running server.
+
+Two tools, both off until asked for and both written out as collapsed
+stacks ("frame;frame;frame weight" per line), which flamegraph.pl,
+speedscope and inferno read as they are:
+
+    spans     wall time of the hot-path stages (handshake, history load,
+              Redis calls, decoding, delivery...). Nested spans become
+              nested frames; the weight is each stage's own microseconds,
+              excluding the stages inside it.
+    profile   a sampling profiler: every SAMPLE_INTERVAL it records the
+              stack of every thread (wall clock, so threads blocked in a
+              read are counted too). The weight is the number of samples.
+
+SIGUSR1 starts or stops the spans, SIGUSR2 the profiler; stopping writes
+<kind>-<pid>-<time>.folded to the profile directory. The metrics endpoint
+also serves /debug/spans?seconds=N and /debug/profile?seconds=N, which
+capture for N seconds and return the file's contents.
+
+While spans are off, a span is one attribute check and a shared no-op
+context manager.
+"""
+
+import os
+import re
+import sys
+import time
+import signal
+import threading
+import contextvars
+from contextlib import contextmanager, nullcontext
+
+SAMPLE_INTERVAL = 0.01
+MAX_CAPTURE_SECONDS = 300
+
+NO_SPAN = nullcontext()
+# The spans open in the current thread or asyncio task, outermost first
+current_path = contextvars.ContextVar("span_path", default=())
+# "Thread-12 (client_thread)" and "Thread-13 (client_thread)" are one stack root
+THREAD_NUMBER = re.compile(r"-\d+")
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        # span path -> [count, seconds]
+        self.totals = {}
+
+    def span(self, stage):
+        if not self.enabled:
+            return NO_SPAN
+        return self.timed(stage)
+
+    @contextmanager
+    def timed(self, stage):
+        path = current_path.get() + (stage,)
+        token = current_path.set(path)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            current_path.reset(token)
+            with self.lock:
+                total = self.totals.setdefault(path, [0, 0.0])
+                total[0] += 1
+                total[1] += elapsed
+
+    def start(self):
+        with self.lock:
+            self.totals = {}
+        self.enabled = True
+
+    def stop(self):
+        """Stop recording; return {span path: [count, seconds]}."""
+        self.enabled = False
+        with self.lock:
+            return dict(self.totals)
+
+
+def span_stacks(totals):
+    """Collapsed stacks weighted by each span's own time in microseconds."""
+    own = {path: seconds for path, (count, seconds) in totals.items()}
+    for path, (count, seconds) in totals.items():
+        if len(path) > 1 and path[:-1] in own:
+            own[path[:-1]] -= seconds
+    return {";".join(path): int(seconds * 1e6) for path, seconds in own.items()}
+
+
+def span_summary(totals):
+    lines = [f"{'span':<40} {'count':>8} {'total ms':>10} {'mean ms':>9}"]
+    for path, (count, seconds) in sorted(totals.items()):
+        lines.append(f"{';'.join(path):<40} {count:>8} {seconds * 1000:>10.1f} {seconds / count * 1000:>9.3f}")
+    return "\n".join(lines)
+
+
+def frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.stop_event = None
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        self.stacks = {}
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.sampler_thread, args=(self.stop_event,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling; return {collapsed stack: samples}."""
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        return self.stacks
+
+    def sample(self, own_ident):
+        names = {thread.ident: THREAD_NUMBER.sub("", thread.name) for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread"))
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def sampler_thread(self, stop_event):
+        own_ident = threading.get_ident()
+        while not stop_event.wait(self.interval):
+            self.sample(own_ident)
+
+
+def format_stacks(stacks):
+    return "".join(f"{stack} {weight}\n" for stack, weight in sorted(stacks.items()) if weight > 0)
+
+
+class Instrumentation:
+    """The server's tracer and profiler, with the signal and endpoint controls that switch them."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.tracer = Tracer()
+        self.profiler = SamplingProfiler()
+        # Held while either tool is being switched, so a signal and an
+        # endpoint request cannot both start or stop the same one
+        self.lock = threading.Lock()
+
+    def write(self, kind, stacks):
+        path = os.path.join(self.directory, f"{kind}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        text = format_stacks(stacks)
+        try:
+            with open(path, "w") as f:
+                f.write(text)
+            print(f"Wrote {kind} to {path}")
+        except OSError as e:
+            print(f"Could not write {kind} to {path}: {e}")
+        return text
+
+    def running(self, kind):
+        return self.tracer.enabled if kind == "spans" else self.profiler.running
+
+    def start(self, kind):
+        """Start spans or profile; False if it is already running."""
+        with self.lock:
+            if self.running(kind):
+                return False
+            if kind == "spans":
+                self.tracer.start()
+            else:
+                self.profiler.start()
+            print(f"Started {kind}")
+            return True
+
+    def stop(self, kind):
+        """Stop spans or profile and write its file; return the collapsed stacks, or None if it was not running."""
+        with self.lock:
+            if not self.running(kind):
+                return None
+            if kind == "spans":
+                totals = self.tracer.stop()
+                print(span_summary(totals))
+                return self.write(kind, span_stacks(totals))
+            stacks = self.profiler.stop()
+            print(f"Profiled {self.profiler.samples} samples")
+            return self.write(kind, stacks)
+
+    def toggle(self, kind):
+        if not self.start(kind):
+            self.stop(kind)
+
+    def capture(self, kind, seconds):
+        """Run spans or profile for seconds and return the collapsed stacks, or None if it is already running."""
+        if not self.start(kind):
+            return None
+        time.sleep(min(seconds, MAX_CAPTURE_SECONDS))
+        return self.stop(kind)
+
+    def signal_handlers(self):
+        """(signal number, handler taking no arguments) pairs for the SIGUSR1/SIGUSR2 toggles."""
+        return [
+            (signal.SIGUSR1, lambda: self.toggle("spans")),
+            (signal.SIGUSR2, lambda: self.toggle("profile")),
+        ]
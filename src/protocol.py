@@ -0,0 +1,243 @@
+"""
+Length-prefixed binary framing, negotiated as an alternative to the newline
+text protocol.
+
+A framed client starts the connection with MAGIC instead of the text
+"username--recipient" handshake (a NUL byte never starts a text handshake),
+followed by a HELLO frame. Every frame is
+
+    HEADER (!IBBB): body length, frame type, sender length, recipient length
+    body:           sender, recipient, payload (UTF-8)
+
+so the sender/recipient travel in the header instead of inside the text.
+
+Stamped connections (either protocol) opt in with "since=<ts>" in the
+handshake: the text handshake's third "--" field or the HELLO payload. The
+server then only replays history newer than <ts>, starts every stored
+message it sends with STAMP ("@<ts> ", the message's ID), and answers a
+"/history [<before>] [<limit>]" message with a page of older history
+followed by HISTORY_END.
+
+Rooms are recipients starting with ROOM_PREFIX. A connection joins one by
+naming it as the handshake recipient or by sending "/join #room", and
+leaves with "/leave #room"; messages without an explicit recipient go to
+the room joined last.
+
+"/ping" is a heartbeat: the server drops it, but it keeps an otherwise
+quiet connection from being reaped as idle.
+
+A server that is shutting down sends RECONNECT, a frame or the text line
+"RECONNECT <ms>": the client should stay for that many milliseconds, then
+reconnect (to another replica) and resume with since=.
+
+The text protocol itself is newline-delimited; LineDecoder splits it.
+"""
+
+import re
+import struct
+
+MAGIC = b"\x00CHT1"
+
+HEADER = struct.Struct("!IBBB")
+
+HELLO = 1
+MESSAGE = 2
+HISTORY = 3
+HISTORY_END = 4
+RECONNECT = 5
+
+MAX_FRAME = 16 << 20
+# Sender and recipient lengths are one header byte each
+MAX_NAME = 255
+
+STAMP_RE = re.compile(r"@(\d+\.\d+) ")
+HISTORY_COMMAND = "/history"
+JOIN_COMMAND = "/join"
+LEAVE_COMMAND = "/leave"
+PING_COMMAND = "/ping"
+RECONNECT_LINE = "RECONNECT"
+ROOM_PREFIX = "#"
+
+
+def is_room(recipient):
+    return recipient.startswith(ROOM_PREFIX)
+
+
+def stamp(ts):
+    return f"@{ts:.6f} "
+
+
+def split_stamp(line):
+    """Return (ts, rest of the line), ts being None for unstamped lines."""
+    match = STAMP_RE.match(line)
+    if match is None:
+        return None, line
+    return float(match.group(1)), line[match.end():]
+
+
+def parse_since(options):
+    """Return the last-seen timestamp from "since=<ts>" handshake options, or None if absent."""
+    for option in options.split(","):
+        name, _, value = option.strip().partition("=")
+        if name == "since":
+            try:
+                return float(value) if value else 0.0
+            except ValueError:
+                raise ProtocolError(f"Invalid since: {value!r}")
+    return None
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def encode_frame(frame_type, sender="", recipient="", payload=""):
+    sender = sender.encode("utf-8")
+    recipient = recipient.encode("utf-8")
+    payload = payload.encode("utf-8")
+    if len(sender) > MAX_NAME or len(recipient) > MAX_NAME:
+        raise ProtocolError(f"Sender and recipient are limited to {MAX_NAME} bytes")
+    body_len = len(sender) + len(recipient) + len(payload)
+    return HEADER.pack(body_len, frame_type, len(sender), len(recipient)) + sender + recipient + payload
+
+
+class FrameDecoder:
+    """Incremental frame parser over one reusable receive buffer.
+
+    Bytes are received straight into the buffer (``recv_into``) or copied in
+    once (``feed``); ``frames`` then parses complete frames in place through
+    a memoryview and only materialises the decoded strings. Consumed bytes are
+    reclaimed by moving the unparsed tail to the front when space runs out.
+    """
+
+    def __init__(self, size=65536, max_frame=MAX_FRAME):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.max_frame = max_frame
+
+    def pending(self):
+        return self.end - self.start
+
+    def reserve(self, n):
+        if self.end + n <= len(self.buffer):
+            return
+
+        pending = self.pending()
+        if pending + n > len(self.buffer):
+            # Doubling, but never past what the longest frame plus one read needs
+            grown = bytearray(max(min(len(self.buffer) * 2, HEADER.size + self.max_frame + n), pending + n))
+            grown[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = grown
+            self.view = memoryview(self.buffer)
+        else:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def feed(self, data):
+        self.reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def recv_into(self, sock, size=65536):
+        self.reserve(size)
+        n = sock.recv_into(self.view[self.end:self.end + size])
+        self.end += n
+        return n
+
+    def frames(self):
+        """Yield (type, sender, recipient, payload) for every complete frame buffered."""
+        while self.pending() >= HEADER.size:
+            body_len, frame_type, sender_len, recipient_len = HEADER.unpack_from(self.buffer, self.start)
+            if body_len > self.max_frame or sender_len + recipient_len > body_len:
+                raise ProtocolError(f"Invalid frame header (body length {body_len})")
+
+            frame_end = self.start + HEADER.size + body_len
+            if frame_end > self.end:
+                return
+
+            pos = self.start + HEADER.size
+            try:
+                sender = str(self.view[pos:pos + sender_len], "utf-8")
+                pos += sender_len
+                recipient = str(self.view[pos:pos + recipient_len], "utf-8")
+                pos += recipient_len
+                payload = str(self.view[pos:frame_end], "utf-8")
+            except UnicodeDecodeError as e:
+                raise ProtocolError(f"Invalid UTF-8 in frame: {e}")
+
+            self.start = frame_end
+            if self.start == self.end:
+                self.start = self.end = 0
+            yield frame_type, sender, recipient, payload
+
+
+class LineDecoder:
+    """Incremental newline splitter for the text protocol.
+
+    Received bytes are appended to one bytearray and ``lines`` only scans
+    the bytes that arrived since its last call, decoding each complete line
+    exactly once, so a stream costs O(n) however it was chunked. A line ends
+    at a newline byte, which never occurs inside a UTF-8 sequence, so a
+    character split across two reads is decoded whole. Consumed bytes are
+    dropped from the front of the buffer once they make up most of it.
+    """
+
+    def __init__(self, max_line=MAX_FRAME, errors="strict"):
+        self.buffer = bytearray()
+        self.start = 0
+        self.scanned = 0
+        self.max_line = max_line
+        self.errors = errors
+        # Set by the first newline; until then the peer may be a client
+        # that never terminates its messages
+        self.seen_newline = False
+
+    def pending(self):
+        return len(self.buffer) - self.start
+
+    def compact(self):
+        if self.start and self.start * 2 >= len(self.buffer):
+            del self.buffer[:self.start]
+            self.scanned -= self.start
+            self.start = 0
+
+    def feed(self, data):
+        self.compact()
+        self.buffer += data
+
+    def recv_into(self, sock, size=65536):
+        data = sock.recv(size)
+        self.feed(data)
+        return len(data)
+
+    def lines(self):
+        """Yield every complete line buffered, without its newline."""
+        while True:
+            end = self.buffer.find(b"\n", self.scanned)
+            if end < 0:
+                self.scanned = len(self.buffer)
+                if self.pending() > self.max_line:
+                    raise ProtocolError(f"Line exceeds {self.max_line} bytes")
+                return
+
+            if end - self.start > self.max_line:
+                raise ProtocolError(f"Line exceeds {self.max_line} bytes")
+            self.seen_newline = True
+            line = self.buffer[self.start:end].decode("utf-8", self.errors)
+            self.start = self.scanned = end + 1
+            yield line
+
+    def peek_tail(self):
+        """Return the unterminated rest of the buffer as bytes, leaving it buffered."""
+        return bytes(self.buffer[self.start:])
+
+    def take_tail(self):
+        """Return and discard the unterminated rest of the buffer."""
+        tail = self.buffer[self.start:].decode("utf-8", self.errors)
+        self.buffer.clear()
+        self.start = self.scanned = 0
+        return tail
@@ -0,0 +1,91 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Allows ``rate`` events per second on average and bursts of up to ``burst``.
+
+    Not thread-safe: each bucket is only used from one thread (or the event
+    loop).
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, n=1):
+        self.refill()
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+    def reserve(self, n=1):
+        """Take n tokens even if that goes into debt; return the seconds to wait before using them.
+
+        Callers that wait are served in the order they reserved, and an
+        empty bucket keeps them to ``rate`` on average.
+        """
+        self.refill()
+        self.tokens -= n
+        return max(0, -self.tokens / self.rate)
+
+
+class ConnectLimiter:
+    """Per-IP connection rate limit for the accept path.
+
+    Keeps one TokenBucket per source address, forgetting the least recently
+    seen addresses beyond ``max_tracked``; a forgotten address simply starts
+    again with a full burst.
+    """
+
+    def __init__(self, rate, burst, max_tracked=65536):
+        self.rate = rate
+        self.burst = burst
+        self.max_tracked = max_tracked
+        self.buckets = OrderedDict()
+
+    def allow(self, ip):
+        bucket = self.buckets.get(ip)
+        if bucket is None:
+            bucket = self.buckets[ip] = TokenBucket(self.rate, self.burst)
+            if len(self.buckets) > self.max_tracked:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(ip)
+        return bucket.take()
+
+
+class RoomLimiter:
+    """Message rate limit shared by everyone sending to a room on this server.
+
+    Thread-safe, unlike TokenBucket, since every connection's reader
+    reserves from the same buckets. Rooms not sent to recently are
+    forgotten beyond ``max_tracked``.
+    """
+
+    def __init__(self, rate, burst, max_tracked=65536):
+        self.rate = rate
+        self.burst = burst
+        self.max_tracked = max_tracked
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def reserve(self, room):
+        with self.lock:
+            bucket = self.buckets.get(room)
+            if bucket is None:
+                bucket = self.buckets[room] = TokenBucket(self.rate, self.burst)
+                if len(self.buckets) > self.max_tracked:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(room)
+            return bucket.reserve()
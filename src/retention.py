@@ -0,0 +1,168 @@
+import gzip
+import os
+import threading
+import time
+import uuid
+from urllib.parse import quote
+
+import redis
+
+from history_record import as_json, entry_time
+
+HISTORY_PREFIX = "chat_history:"
+# Keys under HISTORY_PREFIX that are not conversation lists
+RESERVED_SUFFIXES = (":migrating", ":migrated")
+LOCK_PREFIX = "chat_history_trim:"
+
+
+def is_channel_key(key):
+    return key.startswith(HISTORY_PREFIX) and not key.endswith(RESERVED_SUFFIXES)
+
+
+class SegmentArchive:
+    """Appends trimmed history entries to gzip-compressed segment files.
+
+    Each channel gets its own directory of ``<first-write-epoch>.jsonl.gz``
+    segments holding the entries as JSON objects one per line, compact
+    records converted back. Every ``write`` adds
+    one gzip member, which is fsynced before it returns, and a segment is
+    rotated once it grows past ``segment_bytes``.
+    """
+
+    def __init__(self, directory, segment_bytes=64 << 20):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segments = {}
+
+    def segment_path(self, key):
+        path = self.segments.get(key)
+        if path is None or os.path.getsize(path) >= self.segment_bytes:
+            channel_dir = os.path.join(self.directory, quote(key, safe=""))
+            os.makedirs(channel_dir, exist_ok=True)
+            path = os.path.join(channel_dir, f"{time.time():.6f}.jsonl.gz")
+            self.segments[key] = path
+        return path
+
+    def write(self, key, entries):
+        data = "".join(as_json(entry) + "\n" for entry in entries).encode("utf-8")
+        with open(self.segment_path(key), "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="ab") as segment:
+                segment.write(data)
+            raw.flush()
+            os.fsync(raw.fileno())
+
+
+class HistoryRetention:
+    """Background trimming of the per-conversation history lists.
+
+    A list is trimmed from its head (oldest first) down to ``max_entries``
+    entries and/or to entries younger than ``max_age`` seconds; entries
+    written before timestamps were recorded count as expired. Writers only
+    ``touch`` the keys they append to; a trimmer thread visits the touched
+    keys every ``interval`` seconds, plus every conversation key in Redis on
+    start and every ``sweep_interval`` seconds so idle conversations still
+    age out. Each step removes at most ``step`` entries, so no single Redis
+    command grows with the backlog.
+
+    With an ``archive`` the removed entries are written out first, and only
+    trimmed once the archive write succeeded. Replicas take a short-lived
+    per-key lock so two of them never trim (and archive) the same entries.
+    ``on_trim(key, remaining)`` is called after entries were removed.
+    """
+
+    def __init__(self, client, max_entries=0, max_age=0, archive=None, on_trim=None,
+                 interval=5.0, sweep_interval=3600.0, step=1000, lock_ttl=60):
+        self.client = client
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.archive = archive
+        self.on_trim = on_trim
+        self.interval = interval
+        self.sweep_interval = sweep_interval
+        self.step = step
+        self.lock_ttl = lock_ttl
+        self.owner = uuid.uuid4().hex
+        self.dirty = set()
+        self.dirty_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.stats = {"trimmed": 0, "archived": 0, "errors": 0}
+
+    def start(self):
+        threading.Thread(target=self.trimmer_thread, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def touch(self, key):
+        with self.dirty_lock:
+            self.dirty.add(key)
+
+    def sweep(self):
+        for key in self.client.scan_iter(match=HISTORY_PREFIX + "*", count=500):
+            if is_channel_key(key):
+                self.touch(key)
+
+    def trim_count(self, key, head):
+        """How many entries to drop from the head, given the first ``step`` entries (empty if not needed)."""
+        count = 0
+        if self.max_entries:
+            count = self.client.llen(key) - self.max_entries
+        if self.max_age:
+            cutoff = time.time() - self.max_age
+            expired = 0
+            for raw in head:
+                ts = entry_time(raw)
+                if ts is not None and ts >= cutoff:
+                    break
+                expired += 1
+            count = max(count, expired)
+        return min(count, self.step)
+
+    def trim(self, key):
+        lock = LOCK_PREFIX + key
+        if not self.client.set(lock, self.owner, nx=True, ex=self.lock_ttl):
+            return
+        try:
+            while not self.stop_event.is_set():
+                head = []
+                if self.max_age or self.archive is not None:
+                    head = self.client.lrange(key, 0, self.step - 1)
+                count = self.trim_count(key, head)
+                if count <= 0:
+                    return
+
+                if self.archive is not None:
+                    self.archive.write(key, head[:count])
+                    self.stats["archived"] += count
+                # Writers only append at the tail, so the head indexes are stable
+                self.client.ltrim(key, count, -1)
+                self.stats["trimmed"] += count
+                self.client.expire(lock, self.lock_ttl)
+                if self.on_trim is not None:
+                    self.on_trim(key, self.client.llen(key))
+        finally:
+            if self.client.get(lock) == self.owner:
+                self.client.delete(lock)
+
+    def trimmer_thread(self):
+        next_sweep = time.monotonic()
+        while not self.stop_event.is_set():
+            if time.monotonic() >= next_sweep:
+                try:
+                    self.sweep()
+                except redis.RedisError as e:
+                    self.stats["errors"] += 1
+                    print(f"History retention sweep failed: {e}")
+                next_sweep = time.monotonic() + self.sweep_interval
+
+            with self.dirty_lock:
+                keys, self.dirty = self.dirty, set()
+            for key in keys:
+                try:
+                    self.trim(key)
+                except (redis.RedisError, OSError) as e:
+                    self.stats["errors"] += 1
+                    self.touch(key)
+                    print(f"History retention failed for {key}: {e}")
+
+            self.stop_event.wait(self.interval)
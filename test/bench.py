@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+Reproducible benchmark suite for the chat server.
+
+Boots a ChatServer in-process on a free local port, backed by a throwaway
+redis-server (when one is installed) or an in-process fakeredis, and runs
+named scenarios against it. Nothing has to be started by hand and nothing
+touches the network. Every run gets a fresh server and an empty Redis.
+
+Usage:
+    python3 bench.py [options]
+
+Options:
+    --scenarios NAME [...]  Scenarios to run (default: all, see --list)
+    --list                  List the scenarios and exit
+    --engine ENGINE         Server engine: threads or asyncio (default: threads)
+    --redis BACKEND         server (spawn redis-server), fake (fakeredis) or
+                            auto (server if redis-server is on the PATH)
+                            (default: auto)
+    --repeat N              Runs per scenario; each metric reports the median
+                            (default: 3)
+    --output FILE           Write the results as JSON
+    --baseline FILE         Compare against results saved with --output and
+                            exit with status 1 if any metric regressed
+    --tolerance FRACTION    Allowed regression before failing (default: 0.2)
+    --verbose               Show the server's log output
+
+Metrics ending in _per_sec are better when higher, metrics ending in _ms are
+better when lower. A baseline is only comparable when it was recorded on the
+same machine with the same engine and Redis backend; the comparison warns
+when those differ.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import platform
+import argparse
+import threading
+import statistics
+import subprocess
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import redis
+import redis.asyncio as aioredis
+
+from chat_server import ChatServer, ENGINES, redis_options, history_key
+
+BACKENDS = ("auto", "server", "fake")
+
+
+class FakeBackend:
+    name = "fakeredis"
+
+    def __init__(self):
+        import fakeredis
+        self.fakeredis = fakeredis
+        self.server = fakeredis.FakeServer()
+
+    def factory(self):
+        return self.fakeredis.FakeRedis(server=self.server, decode_responses=True)
+
+    def async_factory(self):
+        return self.fakeredis.FakeAsyncRedis(server=self.server, decode_responses=True)
+
+    def close(self):
+        pass
+
+
+class RedisServerBackend:
+    name = "redis-server"
+
+    def __init__(self):
+        port = free_port()
+        self.process = subprocess.Popen(
+            ["redis-server", "--port", str(port), "--bind", "127.0.0.1", "--save", "", "--appendonly", "no"],
+            stdout=subprocess.DEVNULL,
+        )
+        # Both engines (and their helper threads) read the REDIS_* variables
+        os.environ["REDIS_HOST"] = "127.0.0.1"
+        os.environ["REDIS_PORT"] = str(port)
+        client = self.factory()
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                client.ping()
+                break
+            except redis.ConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def factory(self):
+        return redis.Redis(**redis_options())
+
+    def async_factory(self):
+        return aioredis.Redis(**redis_options())
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def make_backend(name):
+    if name == "auto":
+        name = "server" if shutil.which("redis-server") else "fake"
+    if name == "server":
+        return RedisServerBackend()
+    return FakeBackend()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def boot_server(engine, backend, **options):
+    """Start a chat server on a free port in a daemon thread; return (server, port).
+
+    options are passed on to the server's constructor.
+    """
+    if engine == "asyncio":
+        from async_server import AsyncChatServer
+        server = AsyncChatServer(0, redis_factory=backend.factory, async_redis_factory=backend.async_factory, **options)
+    else:
+        server = ChatServer(0, redis_factory=backend.factory, **options)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    threading.Thread(target=server.execute, args=(sock,), daemon=True).start()
+    deadline = time.monotonic() + 10
+    while not sock.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN):
+        if time.monotonic() > deadline:
+            raise RuntimeError("Chat server did not start listening")
+        time.sleep(0.01)
+    return server, sock.getsockname()[1]
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def latency_metrics(latencies, prefix="latency"):
+    return {
+        f"{prefix}_p50_ms": percentile(latencies, 0.50) * 1000,
+        f"{prefix}_p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+async def connect(port, username, recipient="BROADCAST"):
+    """Connect, send the handshake and wait for the history replay to finish."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=1 << 24)
+    writer.write(f"{username}--{recipient}\n".encode("utf-8"))
+    await writer.drain()
+    await reader.readuntil(b"HISTORY_END\n")
+    return reader, writer
+
+
+async def connect_all(port, handshakes, concurrency=64):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(username, recipient):
+        async with semaphore:
+            return await connect(port, username, recipient)
+
+    return await asyncio.gather(*(one(username, recipient) for username, recipient in handshakes))
+
+
+def close_all(connections):
+    for _, writer in connections:
+        writer.close()
+
+
+async def wait_disconnected(server, timeout=30):
+    # Let the server finish its disconnect broadcasts before the next run
+    deadline = time.monotonic() + timeout
+    while server.connections and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+
+async def drain(reader):
+    while await reader.read(65536):
+        pass
+
+
+def bench_message(seq):
+    return f"bench {seq} {time.perf_counter_ns()}\n".encode("utf-8")
+
+
+async def receive_tagged(reader, count, on_message):
+    """Read lines until count bench messages arrived, calling on_message(seq, latency)."""
+    received = 0
+    while received < count:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Server closed the connection")
+        now = time.perf_counter_ns()
+        parts = line.split()
+        if len(parts) < 3 or parts[-3] != b"bench":
+            continue
+        on_message(int(parts[-2]), (now - int(parts[-1])) / 1e9)
+        received += 1
+
+
+async def connect_storm(server, port, client, clients=1000):
+    """Open all connections at once; time each until its history replay ends."""
+    times = []
+    readers = []
+
+    async def one(n):
+        start = time.perf_counter()
+        connection = await connect(port, f"storm_{n}")
+        times.append(time.perf_counter() - start)
+        # Keep reading the join notices like a real client would
+        readers.append(asyncio.ensure_future(drain(connection[0])))
+        return connection
+
+    start = time.perf_counter()
+    connections = await asyncio.gather(*(one(n) for n in range(clients)))
+    elapsed = time.perf_counter() - start
+    close_all(connections)
+    await wait_disconnected(server)
+    for task in readers:
+        task.cancel()
+    return {"connects_per_sec": clients / elapsed, **latency_metrics(times, "connect")}
+
+
+async def broadcast_fanout(server, port, client, users, messages=100):
+    """One sender broadcasts to users receivers, one message per completed fan-out."""
+    receivers = await connect_all(port, [(f"user_{n}", "BROADCAST") for n in range(users)])
+    sender = await connect(port, "sender")
+    remaining = [users] * messages
+    done = [asyncio.Event() for _ in range(messages)]
+    latencies = []
+
+    def on_message(seq, latency):
+        latencies.append(latency)
+        remaining[seq] -= 1
+        if remaining[seq] == 0:
+            done[seq].set()
+
+    tasks = [asyncio.ensure_future(receive_tagged(reader, messages, on_message)) for reader, _ in receivers]
+    start = time.perf_counter()
+    for seq in range(messages):
+        sender[1].write(bench_message(seq))
+        await asyncio.wait_for(done[seq].wait(), 30)
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*tasks)
+
+    close_all(receivers + [sender])
+    await wait_disconnected(server)
+    return {"deliveries_per_sec": users * messages / elapsed, **latency_metrics(latencies)}
+
+
+async def dm_pairs(server, port, client, pairs=50, messages=100):
+    """Pairs of users exchange DMs concurrently, each waiting for its last message to land."""
+    handshakes = []
+    for n in range(pairs):
+        handshakes += [(f"dm_a{n}", f"dm_b{n}"), (f"dm_b{n}", f"dm_a{n}")]
+    connections = await connect_all(port, handshakes)
+    latencies = []
+
+    async def pair(sender, receiver):
+        for seq in range(messages):
+            sender[1].write(bench_message(seq))
+            await asyncio.wait_for(receive_tagged(receiver[0], 1, lambda seq, latency: latencies.append(latency)), 30)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(pair(connections[2 * n], connections[2 * n + 1]) for n in range(pairs)))
+    elapsed = time.perf_counter() - start
+
+    close_all(connections)
+    await wait_disconnected(server)
+    return {"messages_per_sec": pairs * messages / elapsed, **latency_metrics(latencies)}
+
+
+async def history_replay(server, port, client, entries, connections=50):
+    """Seed the broadcast history, then time sequential connects until HISTORY_END."""
+    key = history_key("seed", "BROADCAST")
+    pipe = client.pipeline(transaction=False)
+    for n in range(entries):
+        pipe.rpush(key, json.dumps({"sender": "seed", "recipient": "BROADCAST", "message": f"seed message {n}"}))
+    pipe.execute()
+
+    times = []
+    for n in range(connections):
+        start = time.perf_counter()
+        connection = await connect(port, f"replay_{n}")
+        times.append(time.perf_counter() - start)
+        close_all([connection])
+        await wait_disconnected(server)
+    return {"cold_replay_ms": times[0] * 1000, **latency_metrics(times[1:], "replay")}
+
+
+SCENARIOS = {
+    "connect_storm": (connect_storm, {"clients": 1000}),
+    "broadcast_10": (broadcast_fanout, {"users": 10}),
+    "broadcast_100": (broadcast_fanout, {"users": 100}),
+    "broadcast_1000": (broadcast_fanout, {"users": 1000}),
+    "dm_pairs": (dm_pairs, {"pairs": 50}),
+    "history_replay_1k": (history_replay, {"entries": 1000}),
+    "history_replay_10k": (history_replay, {"entries": 10000}),
+}
+
+
+def run_scenario(name, engine, backend, repeat):
+    function, kwargs = SCENARIOS[name]
+    runs = []
+    for _ in range(repeat):
+        client = backend.factory()
+        client.flushall()
+        server, port = boot_server(engine, backend)
+        try:
+            runs.append(asyncio.run(function(server, port, client, **kwargs)))
+        finally:
+            server.shutdown()
+    return {metric: statistics.median(run[metric] for run in runs) for metric in runs[0]}
+
+
+def compare(results, baseline, tolerance):
+    """Print current vs baseline per metric; return the regressed (scenario, metric) pairs."""
+    for field in ("engine", "redis", "machine"):
+        if baseline["meta"].get(field) != results["meta"][field]:
+            print(f"Warning: baseline {field} is {baseline['meta'].get(field)!r}, "
+                  f"this run used {results['meta'][field]!r}")
+
+    regressions = []
+    print(f"{'Scenario':<20} {'Metric':<20} {'Baseline':>10} {'Current':>10} {'Change':>8}")
+    for name, metrics in results["scenarios"].items():
+        for metric, value in metrics.items():
+            reference = baseline["scenarios"].get(name, {}).get(metric)
+            if not reference:
+                continue
+            change = (value - reference) / reference
+            worse = -change if metric.endswith("_per_sec") else change
+            status = ""
+            if worse > tolerance:
+                status = "REGRESSED"
+                regressions.append((name, metric))
+            print(f"{name:<20} {metric:<20} {reference:>10.2f} {value:>10.2f} {change:>+7.0%} {status}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Chat server benchmark suite',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS),
+                        help='Scenarios to run (default: all)')
+    parser.add_argument('--list', action='store_true', help='List the scenarios and exit')
+    parser.add_argument('--engine', choices=ENGINES, default='threads', help='Server engine (default: threads)')
+    parser.add_argument('--redis', choices=BACKENDS, default='auto', help='Redis backend (default: auto)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario (default: 3)')
+    parser.add_argument('--output', help='Write the results as JSON')
+    parser.add_argument('--baseline', help='Fail if results regressed against this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed regression (default: 0.2)')
+    parser.add_argument('--verbose', action='store_true', help="Show the server's log output")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, (function, kwargs) in SCENARIOS.items():
+            params = ", ".join(f"{key}={value}" for key, value in kwargs.items())
+            print(f"{name:<20} {function.__doc__.splitlines()[0]} ({params})")
+        return
+
+    backend = make_backend(args.redis)
+    results = {
+        "meta": {
+            "engine": args.engine,
+            "redis": backend.name,
+            "machine": platform.node(),
+            "python": platform.python_version(),
+            "repeat": args.repeat,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "scenarios": {},
+    }
+
+    print(f"\n{'='*60}")
+    print(f"Benchmark: {args.engine} engine, {backend.name}, median of {args.repeat} run(s)")
+    print(f"{'='*60}")
+    # The servers log every connection; they keep running in daemon threads
+    # after their scenario, so their output stays redirected until exit
+    report = sys.stdout
+    log = sys.stdout if args.verbose else open(os.devnull, "w")
+    try:
+        with contextlib.redirect_stdout(log):
+            for name in args.scenarios:
+                metrics = run_scenario(name, args.engine, backend, args.repeat)
+                results["scenarios"][name] = metrics
+                print(f"{name:<20} " + "  ".join(f"{metric}={value:.2f}" for metric, value in metrics.items()),
+                      file=report, flush=True)
+    finally:
+        backend.close()
+    print(f"{'='*60}\n")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
+        print("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
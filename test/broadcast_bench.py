@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the broadcast fan-out path of ChatServer.
+
+Compares the per-recipient cost of the original broadcast loop (build and
+encode the frame and take connections_lock once per recipient) with
+ChatServer.deliver_local, which encodes the frame once and snapshots the
+recipients in a single locked pass. No sockets or Redis are involved: the
+connections are registered with placeholder sockets and their outbound
+queues are emptied between rounds.
+
+A second table measures one message to a room of --room-size members while
+the total user count grows: scanning every connection for members against
+the room index that deliver_local uses.
+
+Usage:
+    python3 broadcast_bench.py [options]
+
+Options:
+    --users N [N ...]    Connected user counts to measure (default: 10 1000 10000)
+    --rounds N           Broadcasts per measurement (default: 50)
+    --room-size N        Members of the measured room (default: 10)
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from chat_server import ChatServer
+
+ROOM = "#bench"
+
+
+def legacy_broadcast(server, username, message):
+    """The pre-encoding broadcast loop, kept here as the baseline."""
+    push_msg = f"[{username}]: {message}"
+    with server.connections_lock:
+        connection_keys = list(server.connections.keys())
+
+    for connection_name in connection_keys:
+        if connection_name != username:
+            with server.connections_lock:
+                conn_data = server.connections.get(connection_name)
+
+            if conn_data is not None:
+                server.enqueue(
+                    connection_name, conn_data,
+                    ("\\BROADCAST/" + push_msg + "\n").encode("utf-8")
+                )
+
+
+def current_broadcast(server, username, message):
+    server.deliver_local(username, "BROADCAST", message)
+
+
+def scan_room(server, username, message):
+    """Room delivery without the index: check every connection's memberships."""
+    with server.connections_lock:
+        recipients = [
+            (connection_name, conn_data)
+            for connection_name, conn_data in server.connections.items()
+            if connection_name != username and ROOM in conn_data.rooms
+        ]
+    server.deliver_many(username, ROOM, message, None, recipients)
+
+
+def indexed_room(server, username, message):
+    server.deliver_local(username, ROOM, message)
+
+
+def build_server(users, room_size=0):
+    server = ChatServer(0, overflow_policy="drop_oldest")
+    for i in range(users):
+        conn_data = server.add_connection(f"user_{i}", None, "BROADCAST")
+        if i < room_size:
+            server.join_room(f"user_{i}", conn_data, ROOM)
+    return server
+
+
+def drain(server):
+    for conn_data in server.connections.values():
+        conn_data.outbound.take_all()
+
+
+def measure(server, broadcast, rounds, per_recipient=True):
+    message = "x" * 64
+    elapsed = 0.0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        broadcast(server, "user_0", message)
+        elapsed += time.perf_counter() - start
+        drain(server)
+    if not per_recipient:
+        return elapsed / rounds
+    return elapsed / rounds / max(len(server.connections) - 1, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Broadcast fan-out microbenchmark',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--users', type=int, nargs='+', default=[10, 1000, 10000],
+                        help='Connected user counts to measure (default: 10 1000 10000)')
+    parser.add_argument('--rounds', type=int, default=50, help='Broadcasts per measurement (default: 50)')
+    parser.add_argument('--room-size', type=int, default=10, help='Members of the measured room (default: 10)')
+    args = parser.parse_args()
+
+    print(f"\n{'='*60}")
+    print("Broadcast fan-out cost per recipient")
+    print(f"{'='*60}")
+    print(f"{'Users':>8} {'legacy (ns)':>14} {'pre-encoded (ns)':>18} {'speedup':>9}")
+
+    for users in args.users:
+        server = build_server(users)
+        legacy = measure(server, legacy_broadcast, args.rounds)
+        current = measure(server, current_broadcast, args.rounds)
+        print(f"{users:>8} {legacy*1e9:>14.0f} {current*1e9:>18.0f} {legacy/current:>8.2f}x")
+
+    print(f"{'='*60}")
+    print(f"Room message cost, {args.room_size} members")
+    print(f"{'='*60}")
+    print(f"{'Users':>8} {'scan (us)':>14} {'indexed (us)':>18} {'speedup':>9}")
+
+    for users in args.users:
+        server = build_server(users, args.room_size)
+        scan = measure(server, scan_room, args.rounds, per_recipient=False)
+        indexed = measure(server, indexed_room, args.rounds, per_recipient=False)
+        print(f"{users:>8} {scan*1e6:>14.1f} {indexed*1e6:>18.1f} {scan/indexed:>8.2f}x")
+
+    print(f"{'='*60}\n")
+
+
+if __name__ == "__main__":
+    main()
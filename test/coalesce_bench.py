@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Benchmark for outbound coalescing (--flush-window-ms, --tcp-mode).
+
+Boots a ChatServer in-process (see bench.py) for every combination of flush
+window and TCP mode, connects --receivers clients and lets --senders chatty
+clients each broadcast --messages small lines at --rate messages/sec.
+Reports, per combination:
+    writes/msg   socket writes per delivered message (1.0 means no batching)
+    frames/write mean frames per write, from chat_send_batch_frames
+    p50/p99 ms   send-to-receive latency
+
+A longer window trades latency for fewer writes, system calls and packets.
+
+Usage:
+    python3 coalesce_bench.py [options]
+
+Options:
+    --windows MS [MS ...]   Flush windows to compare (default: 0 2 5)
+    --tcp-modes MODE [...]  TCP modes to compare (default: nodelay)
+    --engine ENGINE         Server engine: threads or asyncio (default: threads)
+    --receivers N           Receiving clients (default: 50)
+    --senders N             Sending clients (default: 5)
+    --messages N            Messages per sender (default: 200)
+    --rate N                Messages/sec per sender (default: 200)
+    --redis BACKEND         server, fake or auto, as for bench.py (default: auto)
+    --verbose               Show the server's log output
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from bench import BACKENDS, make_backend, boot_server, connect_all, close_all, wait_disconnected
+from bench import bench_message, receive_tagged, percentile
+from chat_server import ENGINES, TCP_MODES
+
+
+def writes(server):
+    histogram = server.metrics.send_batch_frames
+    return sum(histogram.counts), histogram.sum
+
+
+async def run(server, port, receivers, senders, messages, rate):
+    readers = await connect_all(port, [(f"co_r{n}", "BROADCAST") for n in range(receivers)])
+    writers = await connect_all(port, [(f"co_s{n}", "BROADCAST") for n in range(senders)])
+    # Let the connect notices go out before counting
+    await asyncio.sleep(0.5)
+    writes_before, frames_before = writes(server)
+    latencies = []
+
+    async def send(writer):
+        start = time.perf_counter()
+        for seq in range(messages):
+            await asyncio.sleep(max(0, start + seq / rate - time.perf_counter()))
+            writer.write(bench_message(seq))
+        await writer.drain()
+
+    total = senders * messages
+    tasks = [receive_tagged(reader, total, lambda seq, latency: latencies.append(latency)) for reader, _ in readers]
+    await asyncio.gather(*(send(writer) for _, writer in writers), *(asyncio.wait_for(task, 60) for task in tasks))
+    writes_after, frames_after = writes(server)
+
+    close_all(readers + writers)
+    await wait_disconnected(server)
+    batches = writes_after - writes_before
+    frames = frames_after - frames_before
+    return batches / (total * receivers), frames / max(1, batches), latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Outbound coalescing benchmark',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--windows', type=float, nargs='+', default=[0, 2, 5],
+                        help='Flush windows in ms to compare (default: 0 2 5)')
+    parser.add_argument('--tcp-modes', nargs='+', choices=TCP_MODES, default=['nodelay'],
+                        help='TCP modes to compare (default: nodelay)')
+    parser.add_argument('--engine', choices=ENGINES, default='threads', help='Server engine (default: threads)')
+    parser.add_argument('--receivers', type=int, default=50, help='Receiving clients (default: 50)')
+    parser.add_argument('--senders', type=int, default=5, help='Sending clients (default: 5)')
+    parser.add_argument('--messages', type=int, default=200, help='Messages per sender (default: 200)')
+    parser.add_argument('--rate', type=float, default=200, help='Messages/sec per sender (default: 200)')
+    parser.add_argument('--redis', choices=BACKENDS, default='auto', help='Redis backend (default: auto)')
+    parser.add_argument('--verbose', action='store_true', help="Show the server's log output")
+    args = parser.parse_args()
+
+    print(f"\n{'='*60}")
+    print(f"Coalescing: {args.engine} engine, {args.senders} senders x {args.messages} messages "
+          f"at {args.rate:g}/s, {args.receivers} receivers")
+    print(f"{'='*60}")
+    print(f"{'Window':>7} {'TCP mode':>9} {'writes/msg':>11} {'frames/write':>13} {'p50 ms':>8} {'p99 ms':>8}")
+    # As in bench.py, the servers' connection logs stay redirected until exit
+    report = sys.stdout
+    log = sys.stdout if args.verbose else open(os.devnull, "w")
+    with contextlib.redirect_stdout(log):
+        for tcp_mode in args.tcp_modes:
+            for window in args.windows:
+                backend = make_backend(args.redis)
+                try:
+                    server, port = boot_server(args.engine, backend, flush_window_ms=window, tcp_mode=tcp_mode)
+                    per_message, per_write, latencies = asyncio.run(
+                        run(server, port, args.receivers, args.senders, args.messages, args.rate)
+                    )
+                finally:
+                    backend.close()
+                print(f"{window:>7g} {tcp_mode:>9} {per_message:>11.3f} {per_write:>13.1f} "
+                      f"{percentile(latencies, 0.5)*1000:>8.2f} {percentile(latencies, 0.99)*1000:>8.2f}",
+                      file=report, flush=True)
+    print(f"{'='*60}\n")
+
+
+if __name__ == "__main__":
+    main()
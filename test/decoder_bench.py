@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for text protocol line decoding (protocol.LineDecoder).
+
+Feeds a history replay of the given size, cut into fixed-size reads, through
+each decoder and reports MB/s:
+    client      the original ChatClient loop: append every read to a buffer
+                and search the whole buffer for HISTORY_END
+    split       the original load test loop: append, then split one line at
+                a time off the front
+    decoder     LineDecoder, as used by the client, server and load test
+
+Every decoder must return the same lines; a mismatch exits with status 1.
+The reads split multi-byte characters, which the original loops could not
+decode one read at a time, so here they work on bytes and decode each line.
+
+Usage:
+    python3 decoder_bench.py [options]
+
+Options:
+    --sizes MB [...]     History sizes in MB (default: 1 4 16)
+    --chunk BYTES        Bytes per read (default: 4096)
+    --decoders NAME ...  Decoders to compare (default: client split decoder)
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from protocol import LineDecoder
+
+DECODERS = ("client", "split", "decoder")
+
+
+def make_history(size):
+    lines = []
+    total = 0
+    n = 0
+    while total < size:
+        line = f"[user_{n % 100}]:[BROADCAST] message {n} – déjà vu {'x' * (n % 80)}\n"
+        lines.append(line)
+        total += len(line.encode("utf-8"))
+        n += 1
+    return ("".join(lines) + "HISTORY_END\n").encode("utf-8")
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def decode_client(reads):
+    buffer = b""
+    for chunk in reads:
+        buffer += chunk
+        if b"HISTORY_END" in buffer:
+            history, _ = buffer.split(b"HISTORY_END", 1)
+            return history.decode("utf-8").splitlines()
+
+
+def decode_split(reads):
+    lines = []
+    buffer = b""
+    for chunk in reads:
+        buffer += chunk
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            if line == b"HISTORY_END":
+                return lines
+            lines.append(line.decode("utf-8"))
+
+
+def decode_decoder(reads):
+    lines = []
+    decoder = LineDecoder()
+    for chunk in reads:
+        decoder.feed(chunk)
+        for line in decoder.lines():
+            if line == "HISTORY_END":
+                return lines
+            lines.append(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Text protocol line decoding benchmark',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 4, 16],
+                        help='History sizes in MB (default: 1 4 16)')
+    parser.add_argument('--chunk', type=int, default=4096, help='Bytes per read (default: 4096)')
+    parser.add_argument('--decoders', nargs='+', choices=DECODERS, default=list(DECODERS),
+                        help='Decoders to compare (default: client split decoder)')
+    args = parser.parse_args()
+
+    functions = {"client": decode_client, "split": decode_split, "decoder": decode_decoder}
+    failed = False
+
+    print(f"\n{'='*60}")
+    print(f"Line decoding: {args.chunk} byte reads")
+    print(f"{'='*60}")
+    print(f"{'Size MB':>8} {'Decoder':>10} {'lines':>10} {'seconds':>10} {'MB/s':>10}")
+    for size_mb in args.sizes:
+        reads = chunks(make_history(int(size_mb * (1 << 20))), args.chunk)
+        expected = None
+        for name in args.decoders:
+            start = time.perf_counter()
+            lines = functions[name](reads)
+            elapsed = time.perf_counter() - start
+            if expected is None:
+                expected = lines
+            elif lines != expected:
+                print(f"{name} returned different lines")
+                failed = True
+            print(f"{size_mb:>8g} {name:>10} {len(lines):>10} {elapsed:>10.3f} {size_mb / elapsed:>10.1f}")
+    print(f"{'='*60}\n")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
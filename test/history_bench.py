@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Connect-time latency benchmark for the chat server.
+
+Measures the time from TCP connect until HISTORY_END arrives, i.e. how long
+a (re)connecting client waits for the history replay before it can chat.
+
+Usage:
+    python3 history_bench.py [options]
+
+Options:
+    --host HOST          Server host (default: localhost)
+    --port PORT          Server port (default: 8888)
+    --connections N      Sequential connects to time (default: 50)
+    --seed N             Append N broadcast messages to Redis first, using the
+                         server's REDIS_* environment variables (default: 0)
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+
+def seed_history(count):
+    import redis
+    from chat_server import redis_options, history_key
+
+    client = redis.Redis(**redis_options())
+    pipe = client.pipeline(transaction=False)
+    for i in range(count):
+        pipe.rpush(
+            history_key("history_bench", "BROADCAST"),
+            json.dumps({"sender": "history_bench", "recipient": "BROADCAST", "message": f"seed message {i}"})
+        )
+    pipe.execute()
+
+
+def connect_once(host, port, username):
+    start = time.perf_counter()
+    sock = socket.create_connection((host, port), timeout=10)
+    try:
+        sock.sendall(f"{username}--BROADCAST\n".encode("utf-8"))
+        received = b""
+        lines = 0
+        while b"HISTORY_END\n" not in received:
+            chunk = sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("Server closed the connection during history replay")
+            received = received[-16:] + chunk
+            lines += chunk.count(b"\n")
+        return time.perf_counter() - start, lines - 1
+    finally:
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Connect-time latency benchmark for the chat server',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--host', default='localhost', help='Server host (default: localhost)')
+    parser.add_argument('--port', type=int, default=8888, help='Server port (default: 8888)')
+    parser.add_argument('--connections', type=int, default=50, help='Sequential connects to time (default: 50)')
+    parser.add_argument('--seed', type=int, default=0, help='Broadcast messages to append to Redis first (default: 0)')
+    args = parser.parse_args()
+
+    if args.seed:
+        seed_history(args.seed)
+
+    latencies = []
+    history_size = 0
+    for i in range(args.connections):
+        latency, history_size = connect_once(args.host, args.port, f"history_bench_{i}")
+        latencies.append(latency)
+
+    latencies.sort()
+    print(f"\n{'='*60}")
+    print(f"Connect-to-HISTORY_END latency ({args.connections} connects, ~{history_size} history lines)")
+    print(f"{'='*60}")
+    print(f"  Average: {statistics.mean(latencies)*1000:.2f}ms")
+    print(f"  P50: {latencies[int(len(latencies) * 0.50)]*1000:.2f}ms")
+    print(f"  P95: {latencies[int(len(latencies) * 0.95)]*1000:.2f}ms")
+    print(f"  Max: {latencies[-1]*1000:.2f}ms")
+    print(f"{'='*60}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,20 +11,97 @@ Options:
     --clients N          Number of concurrent clients (default: 10)
     --messages N         Messages per client (default: 10)
     --delay SECONDS      Delay between messages in seconds (default: 0.1)
+    --rate N             Open-loop mode: send N messages/sec per client on a fixed
+                         schedule instead of sleeping --delay after each send
     --test-type TYPE     Test type: 'direct', 'broadcast', or 'mixed' (default: mixed)
     --duration SECONDS   Test duration in seconds (default: 30)
+    --hold SECONDS       Keep each connection open this long after its last
+                         send (default: 1); with --messages 0 this holds idle
+                         connections
+    --driver DRIVER      'threads' (two threads per client) or 'asyncio' (one
+                         event loop for all clients) (default: threads)
+    --processes N        Split the clients over N driver processes (default: 1)
+    --ramp SECONDS       Time over which clients connect (default: 10ms per client)
+    --ramp-curve CURVE   'linear', 'exp' (connected clients grow exponentially)
+                         or 'step' (10 equal steps) (default: linear)
+
+Every message carries the sender's sequence number and send timestamp, so
+the receiving clients measure delivery latency (send -> receive on another
+client) and count lost, duplicated and reordered messages per sender. The
+timestamps come from the local clock: run all clients on one machine.
+
+In open-loop mode (--rate) the timestamp is the time the message was
+scheduled, not the time it was written. If the server pushes back and a
+sender falls behind its schedule, that waiting shows up as latency, rather
+than stretching the gap between sends and hiding the tail (coordinated
+omission).
+
+A receiver only counts a sender's messages from the first one it sees live.
+Earlier ones arrive through history replay and are not counted as lost. A
+sender the receiver should hear from (every other broadcaster, its direct
+peer) but never sees live counts all of its messages as lost.
+
+For tens of thousands of clients use --driver asyncio, add --processes to
+use more than one core, and raise the server's and this machine's open file
+limits; this script raises its own soft limit to the hard limit.
 """
 
+import os
+import re
+import sys
+import math
+import asyncio
 import socket
 import threading
 import time
 import argparse
 import statistics
+import multiprocessing
 from collections import defaultdict
 from datetime import datetime
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from protocol import LineDecoder
+
+# Appended to every payload: sender, sequence number, send time (ns)
+TAG_RE = re.compile(r"#lt:(\S+):(\d+):(\d+)$")
+
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+DRIVERS = ('threads', 'asyncio')
+RAMP_CURVES = ('linear', 'exp', 'step')
+RAMP_STEPS = 10
+
+
+class StreamStats:
+    """Arrival order of one sender's messages as seen by one receiver."""
+
+    def __init__(self, first_seq):
+        self.first_seq = first_seq
+        self.max_seq = first_seq
+        self.seen = set()
+        self.duplicates = 0
+        self.reordered = 0
+
+    def record(self, seq):
+        if seq in self.seen:
+            self.duplicates += 1
+            return False
+        self.seen.add(seq)
+        if seq < self.max_seq:
+            self.reordered += 1
+        self.max_seq = max(self.max_seq, seq)
+        return True
+
+
 class LoadTestClient:
-    def __init__(self, client_id, host, port, recipient, test_type, messages, delay):
+    def __init__(self, client_id, host, port, recipient, test_type, messages, delay, rate=0, start_at=0, hold=1):
         self.client_id = client_id
         self.username = f"client_{client_id}"
         self.host = host
@@ -33,6 +110,10 @@ class LoadTestClient:
         self.test_type = test_type
         self.messages = messages
         self.delay = delay
+        self.rate = rate
+        self.start_at = start_at
+        self.next_send = start_at
+        self.hold = hold
         self.sock = None
         self.connected = False
         self.stats = {
@@ -40,10 +121,13 @@ class LoadTestClient:
             'messages_received': 0,
             'errors': 0,
             'latencies': [],
+            'schedule_lag': 0,
             'connection_time': None,
             'start_time': None,
             'end_time': None
         }
+        self.streams = {}
+        self.history_done = False
         self.running = False
 
     def connect(self):
@@ -54,8 +138,8 @@ class LoadTestClient:
             self.sock.settimeout(10)  # 10 second timeout
             self.sock.connect((self.host, self.port))
             
-            # Send handshake: username--recipient
-            handshake = f"{self.username}--{self.recipient}"
+            # Send handshake: username--recipient, on a line of its own
+            handshake = f"{self.username}--{self.recipient}\n"
             self.sock.sendall(handshake.encode('utf-8'))
             
             self.stats['connection_time'] = time.time() - start
@@ -69,21 +153,14 @@ class LoadTestClient:
 
     def receive_messages(self):
         """Thread function to receive messages from server."""
-        buffer = ""
+        lines = LineDecoder(errors="replace")
         while self.running and self.connected:
             try:
-                data = self.sock.recv(1024).decode('utf-8')
-                if not data:
+                if lines.recv_into(self.sock) == 0:
                     self.connected = False
                     break
                 
-                buffer += data
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    if line:
-                        if line == "HISTORY_END":
-                            continue
-                        self.stats['messages_received'] += 1
+                self.handle_data(lines)
             except socket.timeout:
                 continue
             except (OSError, BrokenPipeError, ConnectionResetError) as e:
@@ -98,25 +175,63 @@ class LoadTestClient:
                 self.connected = False
                 break
 
+    def handle_data(self, lines):
+        """Process every complete line buffered in the LineDecoder."""
+        for line in lines.lines():
+            if line:
+                if line == "HISTORY_END":
+                    self.history_done = True
+                    continue
+                self.stats['messages_received'] += 1
+                if self.history_done:
+                    self.record_delivery(line)
+
+    def record_delivery(self, line):
+        """Match a live message to its sender's tag and record latency and ordering."""
+        received_at = time.time_ns()
+        match = TAG_RE.search(line)
+        if not match:
+            return
+        sender, seq, sent_at = match.group(1), int(match.group(2)), int(match.group(3))
+
+        stream = self.streams.get(sender)
+        if stream is None:
+            stream = self.streams[sender] = StreamStats(seq)
+        if stream.record(seq):
+            self.stats['latencies'].append((received_at - sent_at) / 1e9)
+
+    def schedule_next(self):
+        """Advance the open-loop schedule; return (seconds to wait, send timestamp in ns)."""
+        wait = self.next_send - time.time()
+        if wait < 0:
+            # Behind schedule: send now, but keep the intended timestamp
+            self.stats['schedule_lag'] = max(self.stats['schedule_lag'], -wait)
+        sent_at = int(self.next_send * 1e9)
+        self.next_send += 1.0 / self.rate
+        return max(0, wait), sent_at
+
+    def message(self, i, sent_at):
+        return f"Test message {i+1} from {self.username} #lt:{self.username}:{i}:{sent_at}\n".encode('utf-8')
+
     def send_messages(self):
         """Send messages to the server."""
         self.stats['start_time'] = time.time()
+        self.next_send = max(self.start_at, time.time())
         
         for i in range(self.messages):
             if not self.running or not self.connected:
                 break
-                
-            message = f"Test message {i+1} from {self.username}"
-            start = time.time()
+
+            if self.rate > 0:
+                wait, sent_at = self.schedule_next()
+                time.sleep(wait)
+            else:
+                sent_at = time.time_ns()
             
             try:
                 if self.sock and self.connected:
-                    self.sock.sendall((message + '\n').encode('utf-8'))
+                    self.sock.sendall(self.message(i, sent_at))
                     self.stats['messages_sent'] += 1
-                    
-                    # Measure round-trip latency (approximate)
-                    latency = time.time() - start
-                    self.stats['latencies'].append(latency)
             except (OSError, BrokenPipeError, ConnectionResetError):
                 # Connection closed, stop sending
                 self.connected = False
@@ -130,7 +245,7 @@ class LoadTestClient:
                 self.connected = False
                 break
             
-            if self.delay > 0:
+            if self.rate <= 0 and self.delay > 0:
                 time.sleep(self.delay)
         
         self.stats['end_time'] = time.time()
@@ -153,7 +268,7 @@ class LoadTestClient:
         self.send_messages()
         
         # Wait a bit for final messages
-        time.sleep(1)
+        time.sleep(self.hold)
         
         self.running = False
         self.connected = False
@@ -163,15 +278,126 @@ class LoadTestClient:
             except:
                 pass
 
+
+class AsyncLoadTestClient(LoadTestClient):
+    """The same client on asyncio streams, so one loop can drive thousands."""
+
+    async def connect(self):
+        try:
+            start = time.time()
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), timeout=10
+            )
+            self.writer.write(f"{self.username}--{self.recipient}\n".encode('utf-8'))
+            await self.writer.drain()
+
+            self.stats['connection_time'] = time.time() - start
+            self.connected = True
+            return True
+        except (OSError, asyncio.TimeoutError) as e:
+            print(f"[{self.username}] Connection error: {e!r}")
+            self.stats['errors'] += 1
+            return False
+
+    async def receive_messages(self):
+        lines = LineDecoder(errors="replace")
+        while self.connected:
+            try:
+                data = await self.reader.read(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            lines.feed(data)
+            self.handle_data(lines)
+        self.connected = False
+
+    async def send_messages(self):
+        self.stats['start_time'] = time.time()
+        self.next_send = max(self.start_at, time.time())
+
+        for i in range(self.messages):
+            if not self.connected:
+                break
+
+            if self.rate > 0:
+                wait, sent_at = self.schedule_next()
+                await asyncio.sleep(wait)
+            else:
+                sent_at = time.time_ns()
+
+            try:
+                self.writer.write(self.message(i, sent_at))
+                await self.writer.drain()
+                self.stats['messages_sent'] += 1
+            except OSError:
+                self.connected = False
+                self.stats['errors'] += 1
+                break
+
+            if self.rate <= 0 and self.delay > 0:
+                await asyncio.sleep(self.delay)
+
+        self.stats['end_time'] = time.time()
+
+    async def run(self, connect_at):
+        await asyncio.sleep(max(0, connect_at - time.time()))
+        if not await self.connect():
+            return
+
+        receiver = asyncio.ensure_future(self.receive_messages())
+        try:
+            await asyncio.sleep(0.5)
+            await self.send_messages()
+            await asyncio.sleep(self.hold)
+        finally:
+            self.connected = False
+            receiver.cancel()
+            self.writer.close()
+
+
+class ClientResult:
+    """Picklable stats of a finished client, sent back by driver processes."""
+
+    def __init__(self, client):
+        self.client_id = client.client_id
+        self.username = client.username
+        self.stats = client.stats
+        self.streams = client.streams
+
+
+def run_worker(tester, client_ids, start_time):
+    return [ClientResult(client) for client in tester.run_clients(client_ids, start_time)]
+
+
+def raise_fd_limit():
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
 class LoadTester:
-    def __init__(self, host, port, num_clients, messages_per_client, delay, test_type, duration):
+    def __init__(self, host, port, num_clients, messages_per_client, delay, test_type, duration, rate=0,
+                 hold=1, driver='threads', processes=1, ramp=None, ramp_curve='linear'):
         self.host = host
         self.port = port
         self.num_clients = num_clients
         self.messages_per_client = messages_per_client
         self.delay = delay
+        self.rate = rate
         self.test_type = test_type
         self.duration = duration
+        self.hold = hold
+        self.driver = driver
+        self.processes = processes
+        # Default keeps the original 10ms stagger between connections
+        self.ramp = num_clients * 0.01 if ramp is None else ramp
+        self.ramp_curve = ramp_curve
         self.clients = []
         self.results = {
             'total_clients': 0,
@@ -180,6 +406,11 @@ class LoadTester:
             'total_messages_sent': 0,
             'total_messages_received': 0,
             'total_errors': 0,
+            'delivered': 0,
+            'lost': 0,
+            'duplicates': 0,
+            'reordered': 0,
+            'max_schedule_lag': 0,
             'connection_times': [],
             'latencies': [],
             'test_duration': 0
@@ -202,6 +433,76 @@ class LoadTester:
             else:
                 return f"client_{(client_id + 1) % self.num_clients}"
 
+    def connect_offset(self, client_id):
+        """Seconds after the start of the test at which a client connects."""
+        n = self.num_clients
+        if self.ramp <= 0 or n <= 1:
+            return 0
+        if self.ramp_curve == 'exp':
+            return self.ramp * math.log(1 + client_id) / math.log(n)
+        if self.ramp_curve == 'step':
+            return self.ramp * math.floor(RAMP_STEPS * client_id / n) / RAMP_STEPS
+        return self.ramp * client_id / n
+
+    def make_client(self, client_id, start_time, client_class):
+        # Open-loop clients share one schedule that begins once everyone is
+        # connected, phase-shifted over one send interval so they do not
+        # all fire at the same instant
+        start_at = 0
+        if self.rate > 0:
+            start_at = start_time + self.ramp + 0.5 + client_id / self.num_clients / self.rate
+        return client_class(
+            client_id, self.host, self.port, self.determine_recipient(client_id),
+            self.test_type, self.messages_per_client, self.delay, self.rate, start_at, self.hold
+        )
+
+    def run_clients(self, client_ids, start_time):
+        """Run the given clients with this process's driver and return them once finished."""
+        if self.driver == 'asyncio':
+            return asyncio.run(self.run_async(client_ids, start_time))
+        return self.run_threads(client_ids, start_time)
+
+    def run_threads(self, client_ids, start_time):
+        clients = []
+        threads = []
+        for i in client_ids:
+            client = self.make_client(i, start_time, LoadTestClient)
+            clients.append(client)
+
+            # Stagger connections along the ramp
+            time.sleep(max(0, start_time + self.connect_offset(i) - time.time()))
+            thread = threading.Thread(target=client.run)
+            thread.start()
+            threads.append(thread)
+
+        # Wait for all threads to complete or duration expires
+        if self.duration > 0:
+            time.sleep(self.duration)
+            # Signal all clients to stop
+            for client in clients:
+                client.running = False
+        else:
+            for thread in threads:
+                thread.join()
+        return clients
+
+    async def run_async(self, client_ids, start_time):
+        clients = [self.make_client(i, start_time, AsyncLoadTestClient) for i in client_ids]
+        tasks = [
+            asyncio.ensure_future(client.run(start_time + self.connect_offset(client.client_id)))
+            for client in clients
+        ]
+
+        timeout = None
+        if self.duration > 0:
+            timeout = max(0, start_time + self.ramp + self.duration - time.time())
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        return clients
+
     def run_test(self):
         """Run the load test."""
         print(f"\n{'='*60}")
@@ -211,39 +512,28 @@ class LoadTester:
         print(f"Port: {self.port}")
         print(f"Clients: {self.num_clients}")
         print(f"Messages per client: {self.messages_per_client}")
-        print(f"Delay between messages: {self.delay}s")
+        if self.rate > 0:
+            print(f"Open-loop rate: {self.rate} messages/sec per client")
+        else:
+            print(f"Delay between messages: {self.delay}s")
         print(f"Test type: {self.test_type}")
         print(f"Duration: {self.duration}s")
+        print(f"Driver: {self.driver} x {self.processes} process(es)")
+        print(f"Ramp: {self.ramp:.2f}s {self.ramp_curve}")
         print(f"{'='*60}\n")
 
         start_time = time.time()
-        
-        # Create and start all clients
-        threads = []
-        for i in range(self.num_clients):
-            recipient = self.determine_recipient(i)
-            client = LoadTestClient(
-                i, self.host, self.port, recipient,
-                self.test_type, self.messages_per_client, self.delay
-            )
-            self.clients.append(client)
-            
-            thread = threading.Thread(target=client.run)
-            thread.start()
-            threads.append(thread)
-            
-            # Stagger connections slightly
-            time.sleep(0.01)
+        client_ids = list(range(self.num_clients))
 
-        # Wait for all threads to complete or duration expires
-        if self.duration > 0:
-            time.sleep(self.duration)
-            # Signal all clients to stop
-            for client in self.clients:
-                client.running = False
+        if self.processes > 1:
+            # Interleave ids so every process connects along the whole ramp
+            with multiprocessing.Pool(self.processes) as pool:
+                slices = pool.starmap(run_worker, [
+                    (self, client_ids[n::self.processes], start_time) for n in range(self.processes)
+                ])
+            self.clients = [client for clients in slices for client in clients]
         else:
-            for thread in threads:
-                thread.join()
+            self.clients = self.run_clients(client_ids, start_time)
 
         # Collect results
         self.collect_results()
@@ -264,6 +554,43 @@ class LoadTester:
             self.results['total_messages_received'] += client.stats['messages_received']
             self.results['total_errors'] += client.stats['errors']
             self.results['latencies'].extend(client.stats['latencies'])
+            self.results['max_schedule_lag'] = max(self.results['max_schedule_lag'], client.stats['schedule_lag'])
+
+        sent = {client.username: client.stats['messages_sent'] for client in self.clients}
+        senders = self.senders_by_recipient()
+        for client in self.clients:
+            for sender, stream in client.streams.items():
+                expected = sent.get(sender, 0) - stream.first_seq
+                self.results['delivered'] += len(stream.seen)
+                self.results['lost'] += max(0, expected - len(stream.seen))
+                self.results['duplicates'] += stream.duplicates
+                self.results['reordered'] += stream.reordered
+            # A sender this receiver never heard from live has no stream:
+            # everything it sent was lost (failed receivers are counted above)
+            if client.stats['connection_time'] is not None:
+                for sender in senders.get("BROADCAST", []) + senders.get(client.username, []):
+                    if sender != client.username and sender not in client.streams:
+                        self.results['lost'] += sent[sender]
+
+    def senders_by_recipient(self):
+        """Map each recipient (a username or BROADCAST) to the usernames that send to it."""
+        senders = {}
+        for client in self.clients:
+            senders.setdefault(self.determine_recipient(client.client_id), []).append(client.username)
+        return senders
+
+    def print_histogram(self, latencies):
+        counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        for latency in latencies:
+            ms = latency * 1000
+            index = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if ms <= bound), len(LATENCY_BUCKETS_MS))
+            counts[index] += 1
+
+        labels = [f"<= {bound}ms" for bound in LATENCY_BUCKETS_MS] + [f"> {LATENCY_BUCKETS_MS[-1]}ms"]
+        peak = max(counts)
+        for label, count in zip(labels, counts):
+            if count:
+                print(f"  {label:>10} {count:>9} {'#' * max(1, 40 * count // peak)}")
 
     def print_results(self):
         """Print test results."""
@@ -288,9 +615,15 @@ class LoadTester:
         print(f"  Sent: {self.results['total_messages_sent']}")
         print(f"  Received: {self.results['total_messages_received']}")
         print(f"  Errors: {self.results['total_errors']}")
+        print(f"  Delivered live: {self.results['delivered']}")
+        print(f"  Lost: {self.results['lost']}")
+        print(f"  Duplicated: {self.results['duplicates']}")
+        print(f"  Reordered: {self.results['reordered']}")
+        if self.rate > 0:
+            print(f"  Max schedule lag: {self.results['max_schedule_lag']*1000:.2f}ms")
         
         if self.results['latencies']:
-            print(f"\nMessage Latency:")
+            print(f"\nDelivery Latency (send -> receive):")
             print(f"  Average: {statistics.mean(self.results['latencies'])*1000:.2f}ms")
             print(f"  Min: {min(self.results['latencies'])*1000:.2f}ms")
             print(f"  Max: {max(self.results['latencies'])*1000:.2f}ms")
@@ -305,6 +638,10 @@ class LoadTester:
                 print(f"  P50: {p50*1000:.2f}ms")
                 print(f"  P95: {p95*1000:.2f}ms")
                 print(f"  P99: {p99*1000:.2f}ms")
+                p999 = sorted_latencies[min(len(sorted_latencies) - 1, int(len(sorted_latencies) * 0.999))]
+                print(f"  P99.9: {p999*1000:.2f}ms")
+            print("\nDelivery Latency Histogram:")
+            self.print_histogram(self.results['latencies'])
         
         if self.results['test_duration'] > 0:
             throughput = self.results['total_messages_sent'] / self.results['test_duration']
@@ -324,10 +661,22 @@ def main():
     parser.add_argument('--clients', type=int, default=10, help='Number of concurrent clients (default: 10)')
     parser.add_argument('--messages', type=int, default=10, help='Messages per client (default: 10)')
     parser.add_argument('--delay', type=float, default=0.1, help='Delay between messages in seconds (default: 0.1)')
+    parser.add_argument('--rate', type=float, default=0,
+                       help='Open-loop messages/sec per client, overrides --delay (default: 0 = closed loop)')
     parser.add_argument('--test-type', choices=['direct', 'broadcast', 'mixed'], default='mixed',
                        help='Test type: direct, broadcast, or mixed (default: mixed)')
     parser.add_argument('--duration', type=int, default=0,
                        help='Test duration in seconds (0 = run until all messages sent, default: 0)')
+    parser.add_argument('--hold', type=float, default=1,
+                       help='Seconds to keep each connection open after its last send (default: 1)')
+    parser.add_argument('--driver', choices=DRIVERS, default='threads',
+                       help='Client driver: threads or asyncio (default: threads)')
+    parser.add_argument('--processes', type=int, default=1,
+                       help='Number of driver processes (default: 1)')
+    parser.add_argument('--ramp', type=float, default=None,
+                       help='Seconds over which clients connect (default: 10ms per client)')
+    parser.add_argument('--ramp-curve', choices=RAMP_CURVES, default='linear',
+                       help='Connection ramp shape: linear, exp or step (default: linear)')
     
     args = parser.parse_args()
     
@@ -338,8 +687,15 @@ def main():
         args.messages,
         args.delay,
         args.test_type,
-        args.duration
+        args.duration,
+        args.rate,
+        args.hold,
+        args.driver,
+        args.processes,
+        args.ramp,
+        args.ramp_curve
     )
+    raise_fd_limit()
     
     try:
         tester.run_test()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for history persistence (ChatServer.save_message).
+
+Runs the same save_message workload once per persistence mode:
+    direct   one synchronous RPUSH per message (the original behaviour)
+    sync     batched pipelines, each sender waits for its batch to be written
+    async    write-behind, senders only enqueue; the time includes the final drain
+
+Usage:
+    python3 persistence_bench.py [options]
+
+Options:
+    --senders N          Concurrent sender threads (default: 8)
+    --messages N         Messages per sender (default: 2000)
+    --modes MODE [...]   Modes to compare (default: direct sync async)
+    --fake               Use an in-process fakeredis instead of the Redis
+                         server from the REDIS_* environment variables
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import redis
+
+from chat_server import ChatServer, redis_options, history_key
+from persistence import PERSISTENCE_MODES
+
+
+def make_factory(fake):
+    if not fake:
+        return lambda: redis.Redis(**redis_options())
+
+    import fakeredis
+    fake_server = fakeredis.FakeServer()
+    return lambda: fakeredis.FakeRedis(server=fake_server, decode_responses=True)
+
+
+def run_mode(mode, factory, senders, messages):
+    server = ChatServer(0, persistence=mode, history_cache_mb=0, redis_factory=factory)
+    server.redis.delete(history_key("persistence_bench", "BROADCAST"))
+    if server.message_writer is not None:
+        server.message_writer.start()
+
+    def sender(i):
+        for n in range(messages):
+            server.save_message("persistence_bench", "BROADCAST", f"message {n} from sender {i}",
+                                server.clock.now())
+
+    threads = [threading.Thread(target=sender, args=(i,)) for i in range(senders)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+    elapsed = time.perf_counter() - start
+
+    stored = server.redis.llen(history_key("persistence_bench", "BROADCAST"))
+    batches = server.message_writer.stats["batches"] if server.message_writer is not None else stored
+    return senders * messages / elapsed, stored, batches
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='History persistence throughput benchmark',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--senders', type=int, default=8, help='Concurrent sender threads (default: 8)')
+    parser.add_argument('--messages', type=int, default=2000, help='Messages per sender (default: 2000)')
+    parser.add_argument('--modes', nargs='+', choices=PERSISTENCE_MODES, default=list(PERSISTENCE_MODES),
+                        help='Modes to compare (default: direct sync async)')
+    parser.add_argument('--fake', action='store_true', help='Use an in-process fakeredis')
+    args = parser.parse_args()
+
+    factory = make_factory(args.fake)
+
+    print(f"\n{'='*60}")
+    print(f"History persistence: {args.senders} senders x {args.messages} messages")
+    print(f"{'='*60}")
+    print(f"{'Mode':>8} {'messages/sec':>14} {'stored':>10} {'round trips':>12}")
+    for mode in args.modes:
+        rate, stored, batches = run_mode(mode, factory, args.senders, args.messages)
+        print(f"{mode:>8} {rate:>14.0f} {stored:>10} {batches:>12}")
+    print(f"{'='*60}\n")
+
+
+if __name__ == "__main__":
+    main()
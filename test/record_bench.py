@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Storage size and replay cost of the history entry formats (history_record.py).
+
+Builds a conversation history in each format and reports, per format:
+    bytes/msg    average stored entry size (UTF-8), what Redis holds per message
+    encode us    CPU per message to build the entry in save_message
+    replay ms    CPU to turn one HISTORY_LIMIT replay into the bytes sent to a
+                 stamped text client (history_entries + encode_history)
+
+Every format must replay the same bytes; a mismatch exits with status 1.
+Redis round trips are left out, as they are the same for every format.
+
+Usage:
+    python3 record_bench.py [options]
+
+Options:
+    --messages N        Entries per replay (default: 1000, the server's HISTORY_LIMIT)
+    --message-size N    Average chat message length in characters (default: 40)
+    --rounds N          Replays timed per format (default: 200)
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from chat_server import HISTORY_LIMIT, MessageClock, history_entries, encode_history
+from history_record import ENCODERS, HISTORY_FORMATS
+
+
+def make_messages(count, size):
+    clock = MessageClock()
+    return [
+        (f"user_{n % 50}", "BROADCAST", f"message {n} " + "x" * max(0, size - 12 + n % 16 - 8), clock.now())
+        for n in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='History entry format benchmark',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--messages', type=int, default=HISTORY_LIMIT,
+                        help=f'Entries per replay (default: {HISTORY_LIMIT})')
+    parser.add_argument('--message-size', type=int, default=40,
+                        help='Average chat message length in characters (default: 40)')
+    parser.add_argument('--rounds', type=int, default=200, help='Replays timed per format (default: 200)')
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages, args.message_size)
+    expected = None
+    failed = False
+
+    print(f"\n{'='*60}")
+    print(f"History formats: {args.messages} entries, ~{args.message_size} character messages")
+    print(f"{'='*60}")
+    print(f"{'Format':>8} {'bytes/msg':>10} {'encode us':>10} {'replay ms':>10} {'speedup':>9}")
+    baseline = None
+    for name in reversed(HISTORY_FORMATS):
+        encode = ENCODERS[name]
+        start = time.perf_counter()
+        stored = [encode(*message) for message in messages]
+        encode_us = (time.perf_counter() - start) / len(stored) * 1e6
+        size = sum(len(raw.encode("utf-8")) for raw in stored) / len(stored)
+
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            replay = encode_history(None, history_entries(stored), stamped=True)
+        replay_ms = (time.perf_counter() - start) / args.rounds * 1000
+
+        if expected is None:
+            expected = replay
+        elif replay != expected:
+            print(f"{name} replayed different bytes")
+            failed = True
+        baseline = baseline or replay_ms
+        print(f"{name:>8} {size:>10.1f} {encode_us:>10.2f} {replay_ms:>10.3f} {baseline / replay_ms:>8.2f}x")
+    print(f"{'='*60}\n")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
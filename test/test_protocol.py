@@ -0,0 +1,178 @@
+"""
+Tests for the protocol layer: the handshakes, frame encoding and the
+incremental decoders the server reads clients with.
+
+Usage:
+    python3 -m pytest test/test_protocol.py
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from chat_server import (
+    MAX_HANDSHAKE, MAX_MESSAGE, buffered_messages, framed_messages, parse_handshake, parse_hello, text_handshake
+)
+from protocol import HELLO, MESSAGE, HEADER, MAX_NAME, FrameDecoder, LineDecoder, ProtocolError, encode_frame
+
+# Names that could forge or break lines for text clients, or are empty
+BAD_NAMES = ["", "x]: hi\nRECONNECT 0\n[y", "a\rb", "a\u2028b", "a\x1eb", "a\x85b", "nul\x00", "tab\tname"]
+
+
+def hello(sender, recipient, options=""):
+    framing = FrameDecoder(max_frame=MAX_MESSAGE)
+    framing.feed(encode_frame(HELLO, sender, recipient, options))
+    return parse_hello(framing)
+
+
+def decoder_with(data, max_line=MAX_MESSAGE):
+    lines = LineDecoder(max_line=max_line)
+    lines.feed(data)
+    return lines
+
+
+def test_parse_hello():
+    assert hello("alice", "BROADCAST") == ("alice", "BROADCAST", None)
+    assert hello("alice", "bob", "since=12.5") == ("alice", "bob", 12.5)
+    assert hello("alice", "#room", "since=") == ("alice", "#room", 0.0)
+
+
+def test_parse_hello_incomplete():
+    framing = FrameDecoder()
+    framing.feed(encode_frame(HELLO, "alice", "BROADCAST")[:-1])
+    assert parse_hello(framing) is None
+
+
+@pytest.mark.parametrize("name", BAD_NAMES)
+def test_parse_hello_rejects_bad_names(name):
+    with pytest.raises(ProtocolError):
+        hello(name, "BROADCAST")
+    with pytest.raises(ProtocolError):
+        hello("alice", name)
+
+
+def test_parse_hello_rejects_rooms_and_other_frames():
+    with pytest.raises(ProtocolError):
+        hello("#room", "BROADCAST")
+    with pytest.raises(ProtocolError):
+        hello("alice", "#bad room")
+    framing = FrameDecoder()
+    framing.feed(encode_frame(MESSAGE, "alice", "BROADCAST", "hi"))
+    with pytest.raises(ProtocolError):
+        parse_hello(framing)
+
+
+def test_parse_handshake():
+    assert parse_handshake("alice--BROADCAST") == ("alice", "BROADCAST", None)
+    assert parse_handshake("alice--bob--since=1.5\n") == ("alice", "bob", 1.5)
+    with pytest.raises(ProtocolError):
+        parse_handshake("alice")
+    with pytest.raises(ProtocolError):
+        parse_handshake("alice--bob--since=soon")
+
+
+@pytest.mark.parametrize("name", [name for name in BAD_NAMES if name.strip()])
+def test_parse_handshake_rejects_bad_names(name):
+    with pytest.raises(ProtocolError):
+        parse_handshake(f"{name}--BROADCAST")
+    with pytest.raises(ProtocolError):
+        parse_handshake(f"alice--{name}")
+
+
+def test_name_length_matches_frame_header():
+    longest = "é" * (MAX_NAME // 2) + "x"
+    assert parse_handshake(f"{longest}--BROADCAST")[0] == longest
+    assert hello(longest, "BROADCAST")[0] == longest
+    # Every accepted name can be sent to framed clients
+    encode_frame(MESSAGE, longest, longest, "hi")
+
+    too_long = "x" * (MAX_NAME + 1)
+    with pytest.raises(ProtocolError):
+        parse_handshake(f"{too_long}--BROADCAST")
+    with pytest.raises(ProtocolError):
+        parse_handshake(f"alice--{too_long}")
+    with pytest.raises(ProtocolError):
+        encode_frame(MESSAGE, too_long, "BROADCAST", "hi")
+
+
+def test_encode_frame_round_trip():
+    framing = FrameDecoder(size=16)
+    data = encode_frame(MESSAGE, "alice", "bob", "héllo") + encode_frame(MESSAGE, payload="")
+    # One byte at a time, so every frame and character is split across reads
+    frames = []
+    for i in range(len(data)):
+        framing.feed(data[i:i + 1])
+        frames.extend(framing.frames())
+    assert frames == [(MESSAGE, "alice", "bob", "héllo"), (MESSAGE, "", "", "")]
+    assert framing.pending() == 0
+
+
+def test_frame_decoder_limit():
+    framing = FrameDecoder(max_frame=MAX_MESSAGE)
+    framing.feed(HEADER.pack(MAX_MESSAGE + 1, MESSAGE, 0, 0))
+    with pytest.raises(ProtocolError):
+        list(framing.frames())
+
+
+def test_frame_decoder_growth_is_bounded():
+    framing = FrameDecoder(size=1024, max_frame=4096)
+    framing.feed(HEADER.pack(4096, MESSAGE, 0, 0))
+    for _ in range(4):
+        framing.feed(b"x" * 1000)
+        assert list(framing.frames()) == []
+    assert len(framing.buffer) <= HEADER.size + 4096 + 1000
+
+
+def test_framed_messages_cannot_forge_lines():
+    framing = FrameDecoder()
+    framing.feed(encode_frame(MESSAGE, "alice", "", "hi\nRECONNECT 0 there")
+                 + encode_frame(MESSAGE, "alice", "bob\nRECONNECT 0", "sneaky")
+                 + encode_frame(MESSAGE, "alice", "bob", "hello"))
+    assert framed_messages(framing) == [(None, "hi RECONNECT 0 there"), ("bob", "hello")]
+
+
+def test_line_decoder_split_reads():
+    lines = LineDecoder()
+    data = "héllo\nwörld\npartial".encode("utf-8")
+    result = []
+    for i in range(len(data)):
+        lines.feed(data[i:i + 1])
+        result.extend(lines.lines())
+    assert result == ["héllo", "wörld"]
+    assert lines.take_tail() == "partial"
+    assert lines.pending() == 0
+
+
+def test_line_decoder_limit():
+    unterminated = decoder_with(b"x" * 101, max_line=100)
+    with pytest.raises(ProtocolError):
+        list(unterminated.lines())
+    # A long line that arrived whole, newline included, is refused too
+    complete = decoder_with(b"x" * 101 + b"\n", max_line=100)
+    with pytest.raises(ProtocolError):
+        list(complete.lines())
+    assert list(decoder_with(b"x" * 100 + b"\n", max_line=100).lines()) == ["x" * 100]
+
+
+def test_buffered_messages_drops_oversized_input():
+    assert buffered_messages(None, decoder_with(b"x" * (MAX_MESSAGE + 1))) is None
+    framing = FrameDecoder(max_frame=MAX_MESSAGE)
+    framing.feed(HEADER.pack(MAX_MESSAGE + 1, MESSAGE, 0, 0))
+    assert buffered_messages(framing, None) is None
+
+
+def test_text_handshake_first_line():
+    lines = decoder_with(b"dave--BROADCAST\nearly msg\n")
+    assert text_handshake(lines) == "dave--BROADCAST"
+    assert list(lines.lines()) == ["early msg"]
+
+
+def test_text_handshake_unterminated():
+    # Clients that never send a newline write the handshake on its own
+    assert text_handshake(decoder_with(b"sam--BROADCAST")) == "sam--BROADCAST"
+    assert text_handshake(decoder_with(b"sam--")) is None
+    with pytest.raises(ProtocolError):
+        text_handshake(decoder_with(b"x" * (MAX_HANDSHAKE + 1)))
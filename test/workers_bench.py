@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Scaling benchmark for the multi-process serving mode (chat_server.py --workers).
+
+For each worker count, starts "chat_server.py <port> --workers N" as a
+subprocess against a throwaway redis-server and drives DM pairs at it from
+several load processes, so the load generator is not the bottleneck. Pairs
+land on random workers, so most messages cross workers through Redis
+fan-out, as they would across replicas; every run passes --fanout, so one
+worker pays the same Redis cost. Reports delivered messages/sec and
+the speedup over the first worker count.
+
+Scaling is bounded by the cores on the machine, which are shared by the
+workers, the load processes and Redis.
+
+Usage:
+    python3 workers_bench.py [options]
+
+Options:
+    --workers N [N ...]     Worker counts to compare (default: 1 2 4)
+    --engine ENGINE         Server engine: threads or asyncio (default: threads)
+    --load-processes N      Load generating processes (default: 4)
+    --pairs N               DM pairs per load process (default: 25)
+    --messages N            Messages per pair (default: 400)
+    --window N              Messages a sender has in flight (default: 20)
+    --redis BACKEND         server (spawn redis-server) or external (use
+                            REDIS_HOST/REDIS_PORT) (default: server)
+"""
+
+import os
+import sys
+import time
+import asyncio
+import threading
+import argparse
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import redis
+
+from bench import RedisServerBackend, free_port, connect, bench_message, receive_tagged, percentile
+from chat_server import ENGINES, redis_options
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "chat_server.py")
+
+
+class ExternalBackend:
+    name = "external"
+
+    def factory(self):
+        return redis.Redis(**redis_options())
+
+    def close(self):
+        pass
+
+
+def start_server(port, workers, engine):
+    process = subprocess.Popen(
+        [sys.executable, "-u", SERVER, str(port), "--workers", str(workers), "--engine", engine, "--fanout"],
+        stdout=subprocess.PIPE, text=True,
+    )
+    # Wait until every worker is listening, then keep draining the log
+    listening = 0
+    for line in process.stdout:
+        if line.startswith("Listening for connections"):
+            listening += 1
+            if listening == workers:
+                break
+    if listening < workers:
+        process.terminate()
+        raise RuntimeError("Chat server did not start listening")
+    threading.Thread(target=process.stdout.read, daemon=True).start()
+    return process
+
+
+async def drive(port, first_pair, pairs, messages, window, start_at):
+    connections = []
+    for n in range(first_pair, first_pair + pairs):
+        connections.append((await connect(port, f"wb_a{n}", f"wb_b{n}"), await connect(port, f"wb_b{n}", f"wb_a{n}")))
+    latencies = []
+
+    async def pair(sender, receiver):
+        sent = 0
+        while sent < messages:
+            batch = min(window, messages - sent)
+            for seq in range(sent, sent + batch):
+                sender[1].write(bench_message(seq))
+            await sender[1].drain()
+            await asyncio.wait_for(receive_tagged(receiver[0], batch, lambda seq, latency: latencies.append(latency)), 60)
+            sent += batch
+
+    await asyncio.sleep(max(0, start_at - time.time()))
+    await asyncio.gather(*(pair(sender, receiver) for sender, receiver in connections))
+    finished = time.time()
+
+    for sender, receiver in connections:
+        sender[1].close()
+        receiver[1].close()
+    return finished, latencies
+
+
+def load_process(args):
+    return asyncio.run(drive(*args))
+
+
+def run(port, processes, pairs, messages, window):
+    # Every process connects first, then all start sending at the same moment
+    start_at = time.time() + 2 + processes * pairs * 0.01
+    jobs = [(port, index * pairs, pairs, messages, window, start_at) for index in range(processes)]
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(load_process, jobs)
+
+    elapsed = max(finished for finished, _ in results) - start_at
+    latencies = [latency for _, samples in results for latency in samples]
+    return processes * pairs * messages / elapsed, percentile(latencies, 0.5), percentile(latencies, 0.99)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Multi-process serving scaling benchmark',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help='Worker counts to compare (default: 1 2 4)')
+    parser.add_argument('--engine', choices=ENGINES, default='threads', help='Server engine (default: threads)')
+    parser.add_argument('--load-processes', type=int, default=4, help='Load generating processes (default: 4)')
+    parser.add_argument('--pairs', type=int, default=25, help='DM pairs per load process (default: 25)')
+    parser.add_argument('--messages', type=int, default=400, help='Messages per pair (default: 400)')
+    parser.add_argument('--window', type=int, default=20, help='Messages a sender has in flight (default: 20)')
+    parser.add_argument('--redis', choices=('server', 'external'), default='server',
+                        help='Redis backend (default: server)')
+    args = parser.parse_args()
+
+    backend = RedisServerBackend() if args.redis == 'server' else ExternalBackend()
+    print(f"\n{'='*60}")
+    print(f"Workers scaling: {args.engine} engine, {os.cpu_count()} CPUs, "
+          f"{args.load_processes}x{args.pairs} DM pairs x {args.messages} messages")
+    print(f"{'='*60}")
+    print(f"{'Workers':>8} {'messages/sec':>14} {'p50 ms':>10} {'p99 ms':>10} {'speedup':>9}")
+    try:
+        first = None
+        for workers in args.workers:
+            backend.factory().flushall()
+            port = free_port()
+            server = start_server(port, workers, args.engine)
+            try:
+                rate, p50, p99 = run(port, args.load_processes, args.pairs, args.messages, args.window)
+            finally:
+                server.terminate()
+                server.wait()
+            first = first or rate
+            print(f"{workers:>8} {rate:>14.0f} {p50*1000:>10.2f} {p99*1000:>10.2f} {rate/first:>8.2f}x",
+                  flush=True)
+    finally:
+        backend.close()
+    print(f"{'='*60}\n")
+
+
+if __name__ == "__main__":
+    main()